@@ -1,8 +1,10 @@
 import os
 from functools import partial
-import threading
+from warnings import warn
 import numpy as np
 
+from cluster_tools.utils.numba_utils import jit
+
 # try to load the frameworks
 try:
     import torch
@@ -24,11 +26,6 @@ try:
 except ImportError:
     TestTimeAugmenter = None
 
-try:
-    from apex import amp
-except ImportError:
-    amp = None
-
 
 #
 # Prediction classes
@@ -42,25 +39,41 @@ class PytorchPredicter:
         return TestTimeAugmenter.default_tda(augmentation_dim, augmentation_mode)
 
     def set_up(self, halo, gpu, use_best, prep_model,
-               mixed_precision, **augmentation_kwargs):
+               mixed_precision, gpu_preprocess=False,
+               preprocess_kwargs=None, compile_model=False,
+               **augmentation_kwargs):
         self.model.eval()
         self.gpu = gpu
         self.model.cuda(self.gpu)
         if prep_model is not None:
             self.model = prep_model(self.model)
+        if compile_model:
+            self.compile()
 
+        # we use native torch autocast for mixed precision inference
         self.mixed_precision = mixed_precision
-        if self.mixed_precision:
-            assert amp is not None, "Need apex to use mixed precision inference"
-            opt_level = 'O1'  # TODO allow to set opt level
-            self.model = amp.initialize(self.model, opt_level=opt_level)
+        self.autocast_dtype = torch.float16 if mixed_precision else None
+        # tensor cores need the spatial shape to be a multiple of 8 for float16
+        self.tc_align = 8
+
+        # normalize the inputs on the gpu instead of the host (see 'get_preprocessor')
+        self.gpu_preprocess = gpu_preprocess
+        self.preprocess_kwargs = {} if preprocess_kwargs is None else preprocess_kwargs
 
         # save the halo and check if this is a multi-scale halo
         # (halo is nested list)
         self.halo = halo
         self.has_multiscale_halo = isinstance(halo[0], list)
 
-        self.lock = threading.Lock()
+        # NOTE the predictor is not thread-safe: the inference tasks only call it from a single
+        # thread (see '_run_pipeline' in inference.py), so we don't need to lock the gpu.
+        # we copy the data to the gpu on a separate stream via page-locked (pinned) staging buffers,
+        # so that the transfers are asynchronous
+        self.copy_stream = torch.cuda.Stream(device=self.gpu)
+        self.pinned_buffers = {}
+        # the input tensors on the gpu are also kept and re-used across calls
+        self.device_buffers = {}
+
         # build the test-time-augmenter if we have augmentation kwargs
         if augmentation_kwargs:
             assert TestTimeAugmenter is not None, "Need neurofire for test-time-augmentation"
@@ -70,12 +83,26 @@ class PytorchPredicter:
             self.augmenter = None
 
     def __init__(self, model_path, halo, gpu=0, use_best=True, prep_model=None,
-                 mixed_precision=False, **augmentation_kwargs):
+                 mixed_precision=False, gpu_preprocess=False, preprocess_kwargs=None,
+                 compile_model=False, **augmentation_kwargs):
         # load the model and prep it if specified
         assert os.path.exists(model_path), model_path
         self.model = torch.load(model_path)
         self.set_up(halo, gpu, use_best, prep_model, mixed_precision,
-                    **augmentation_kwargs)
+                    gpu_preprocess, preprocess_kwargs, compile_model, **augmentation_kwargs)
+
+    def compile(self):
+        # torch.compile (torch >= 2.0) fuses the model's operations and in 'reduce-overhead' mode
+        # captures a cuda graph after warm-up, which removes the per-block launch overhead;
+        # it recompiles for every new input shape, so this pays off if all blocks have the same shape.
+        # for older torch versions we try to script the model and otherwise keep running it eagerly
+        if hasattr(torch, 'compile'):
+            self.model = torch.compile(self.model, mode='reduce-overhead', fullgraph=False)
+            return
+        try:
+            self.model = torch.jit.script(self.model)
+        except Exception as e:
+            warn("Could not script the model, running it eagerly: %s" % str(e))
 
     def crop(self, out, halo):
         shape = out.shape if out.ndim == 3 else out.shape[1:]
@@ -84,22 +111,173 @@ class PytorchPredicter:
             bb = (slice(None),) + bb
         return out[bb]
 
-    def apply_model(self, input_data):
-        with self.lock, torch.no_grad():
-            if isinstance(input_data, np.ndarray):
-                torch_data = torch.from_numpy(input_data[None, None]).cuda(self.gpu)
-            else:
-                torch_data = [torch.from_numpy(d[None, None]).cuda(self.gpu) for d in input_data]
-            out = self.model(torch_data)
-            # we send the data
+    def get_pinned_buffer(self, name, shape, dtype):
+        # we keep one buffer per name and only allocate new page-locked memory if its shape
+        # or dtype changes (e.g. for blocks at the border); buffers without a name are not cached
+        buffer = None if name is None else self.pinned_buffers.get(name, None)
+        if buffer is None or tuple(buffer.shape) != tuple(shape) or buffer.dtype != dtype:
+            buffer = torch.empty(shape, dtype=dtype, pin_memory=True)
+            if name is not None:
+                self.pinned_buffers[name] = buffer
+        return buffer
+
+    def get_device_buffer(self, name, shape, dtype):
+        buffer = None if name is None else self.device_buffers.get(name, None)
+        if buffer is None or tuple(buffer.shape) != tuple(shape) or buffer.dtype != dtype:
+            buffer = torch.empty(shape, dtype=dtype, device=self.gpu)
+            if name is not None:
+                self.device_buffers[name] = buffer
+        return buffer
+
+    def upload(self, batches, names):
+        # stack each batch into its pinned buffer (adding the channel axis) and issue
+        # all non-blocking transfers on the copy stream, so that the compute stream
+        # only needs to wait once for all inputs (e.g. for all scales of multi-scale inputs)
+        compute_stream = torch.cuda.current_stream(self.gpu)
+        # the copies must not start before the compute stream is done with the previous content
+        self.copy_stream.wait_stream(compute_stream)
+        tensors = []
+        with torch.cuda.stream(self.copy_stream):
+            for batch, name in zip(batches, names):
+                shape = (len(batch), 1) + batch[0].shape
+                dtype = torch.from_numpy(batch[0]).dtype
+                pinned = self.get_pinned_buffer(name, shape, dtype)
+                np.stack(batch, out=pinned.numpy()[:, 0])
+                tensor = self.get_device_buffer(name, shape, dtype)
+                tensor.copy_(pinned, non_blocking=True)
+                # uncached tensors are allocated on the copy stream, but freed after use on the compute stream
+                if name is None:
+                    tensor.record_stream(compute_stream)
+                tensors.append(tensor)
+        compute_stream.wait_stream(self.copy_stream)
+        return tensors
+
+    def prepare(self, tensor, pad_width=None):
+        if self.gpu_preprocess:
+            tensor = self.normalize(tensor, **self.preprocess_kwargs)
+        # pad on the gpu if the input was loaded without padding
+        if pad_width is not None:
+            tensor = self.pad(tensor, pad_width)
+        return tensor
+
+    # same normalization as 'preprocess_torch', but for each sample of a batch on the gpu
+    def normalize(self, tensor, mean=None, std=None,
+                  use_zero_mean_unit_variance=True, eps=1e-4):
+        tensor = tensor.float()
+        flat = tensor.view(tensor.shape[0], -1)
+        stat_shape = (-1,) + (1,) * (tensor.ndim - 1)
+
+        if not use_zero_mean_unit_variance:
+            min_ = flat.min(dim=1).values.view(stat_shape)
+            max_ = flat.max(dim=1).values.view(stat_shape)
+            return (tensor - min_) / (max_ + eps)
+
+        if mean is None or std is None:
+            # zeros are filtered from the statistics; they don't change the sums, only the count
+            n_values = torch.count_nonzero(flat, dim=1).clamp(min=1)
+            sum_ = flat.sum(dim=1, dtype=torch.float64)
+            sum_sq = torch.linalg.vector_norm(flat, dim=1, dtype=torch.float64) ** 2
+            data_mean = sum_ / n_values
+            data_std = (sum_sq / n_values - data_mean ** 2).clamp(min=0).sqrt()
+            mean = data_mean.float().view(stat_shape) if mean is None else mean
+            std = data_std.float().view(stat_shape) if std is None else std
+        return (tensor - mean) * (1. / (std + eps))
+
+    def pad(self, tensor, pad_width, mode='reflect'):
+        # torch expects the padding for the last axis first
+        pad = [pad for axis_pad in reversed(pad_width) for pad in axis_pad]
+        return torch.nn.functional.pad(tensor, pad, mode=mode)
+
+    def inputs_to_device(self, input_data, pad_widths=None):
+        # input data is a list of arrays or a list of lists of arrays (for multi-scale inputs)
+        multiscale = not isinstance(input_data[0], np.ndarray)
+        n_scales = len(input_data[0]) if multiscale else 1
+        # multi-scale inputs have one pad width per scale, which are all None if the input is not padded
+        unpadded = pad_widths is None or all(
+            pad_width is None or (multiscale and all(scale_pad is None for scale_pad in pad_width))
+            for pad_width in pad_widths
+        )
+        if unpadded:
+            # all inputs have the same shape, so we can transfer them as one batch per scale
+            batches = list(zip(*input_data)) if multiscale else [input_data]
+            names = ['input%i' % scale for scale in range(n_scales)]
+            tensors = [self.prepare(tensor) for tensor in self.upload(batches, names)]
+            return tensors if multiscale else tensors[0]
+
+        # inputs that still need to be padded can have different shapes,
+        # so we transfer and pad them individually and concatenate them on the gpu;
+        # their buffers are not cached (no names), because the shapes change between blocks
+        batches = [[data] for data in input_data] if not multiscale else\
+            [[data] for scale_data in input_data for data in scale_data]
+        names = [None] * len(batches)
+        pad_widths = [None if pad_width is None else (pad_width[scale] if multiscale else pad_width)
+                      for pad_width in pad_widths for scale in range(n_scales)]
+        tensors = [self.prepare(tensor, pad_width)
+                   for tensor, pad_width in zip(self.upload(batches, names), pad_widths)]
+        tensors = [torch.cat(tensors[scale::n_scales]) for scale in range(n_scales)]
+        return tensors if multiscale else tensors[0]
+
+    # remove the tensor core alignment padding from outputs that have the padded spatial shape
+    def crop_alignment(self, out, padded_shape, tc_pad):
+        def _crop(tensor):
+            if tensor.shape[2:] != padded_shape:
+                return tensor
+            bb = tuple(slice(0, sh - pad) for sh, pad in zip(padded_shape, tc_pad))
+            return tensor[(slice(None), slice(None)) + bb]
+        if torch.is_tensor(out):
+            return _crop(out)
+        elif isinstance(out, (list, tuple)):
+            return [_crop(o) for o in out]
+        return out
+
+    def to_host(self, tensor, name='output'):
+        # we send the data back to the cpu, in float32 in case we ran with mixed precision
+        tensor = tensor.float()
+        pinned = self.get_pinned_buffer(name, tensor.shape, tensor.dtype)
+        pinned.copy_(tensor, non_blocking=True)
+        return pinned
+
+    def apply_model_batched(self, input_data, pad_widths=None):
+        # we stack the inputs into a single batch to predict all of them in one forward pass
+        with torch.inference_mode():
+            torch_data = self.inputs_to_device(input_data, pad_widths)
+
+            # for mixed precision we pad the input to a tensor core friendly shape
+            tc_pad = None
+            if self.mixed_precision and torch.is_tensor(torch_data):
+                tc_pad = [(-sh) % self.tc_align for sh in torch_data.shape[2:]]
+                if any(tc_pad):
+                    torch_data = self.pad(torch_data, [(0, pad) for pad in tc_pad], mode='constant')
+                else:
+                    tc_pad = None
+
+            with torch.autocast('cuda', dtype=self.autocast_dtype, enabled=self.mixed_precision):
+                out = self.model(torch_data)
+
+            if tc_pad is not None:
+                out = self.crop_alignment(out, torch_data.shape[2:], tc_pad)
+
             if torch.is_tensor(out):
-                out = out.cpu().numpy().squeeze()
+                out = self.to_host(out)
             elif isinstance(out, (list, tuple)):
-                out = [o.cpu().numpy().squeeze() for o in out]
+                out = [self.to_host(o, name='output%i' % ii) for ii, o in enumerate(out)]
             else:
                 raise TypeError("Expect model output to be tensor or list of tensors, got %s" % type(out))
+
+            # wait for the device to host transfers to finish and copy out of the pinned buffers,
+            # because they are re-used in the next call; split the batch into the individual outputs
+            torch.cuda.synchronize(self.gpu)
+            if torch.is_tensor(out):
+                out = [o.squeeze().copy() for o in out.numpy()]
+            else:
+                out = [[o.squeeze().copy() for o in outs]
+                       for outs in zip(*[o.numpy() for o in out])]
         return out
 
+    def apply_model(self, input_data, pad_width=None):
+        pad_widths = None if pad_width is None else [pad_width]
+        return self.apply_model_batched([input_data], pad_widths)[0]
+
     def apply_model_with_augmentations(self, input_data):
         out = self.augmenter(input_data, self.apply_model, self.offsets)
         return out
@@ -113,12 +291,7 @@ class PytorchPredicter:
         else:
             raise ValueError("Need array or list of arrays")
 
-    def __call__(self, input_data):
-        self.check_data(input_data)
-        if self.augmenter is None:
-            out = self.apply_model(input_data)
-        else:
-            out = self.apply_model_with_augmentations(input_data)
+    def crop_output(self, out):
         if isinstance(out, list) and self.has_multiscale_halo:
             assert len(self.halo) == len(out) and all(isinstance(halo, list) for halo in self.halo)
             out = [self.crop(oo, halo) for oo, halo in zip(out, self.halo)]
@@ -129,10 +302,33 @@ class PytorchPredicter:
             out = self.crop(out, self.halo)
         return out
 
+    # pad_width can be given for inputs that were loaded without padding,
+    # they are then padded (with reflect mode) on the gpu
+    def __call__(self, input_data, pad_width=None):
+        self.check_data(input_data)
+        if self.augmenter is None:
+            out = self.apply_model(input_data, pad_width)
+        else:
+            out = self.apply_model_with_augmentations(pad_inputs(input_data, pad_width))
+        return self.crop_output(out)
+
+    # predict a list of inputs, which must all have the same shape after padding, with a single forward pass
+    def predict_batch(self, inputs, pad_widths=None):
+        for input_data in inputs:
+            self.check_data(input_data)
+        if self.augmenter is None:
+            outputs = self.apply_model_batched(inputs, pad_widths)
+        else:
+            pad_widths = [None] * len(inputs) if pad_widths is None else pad_widths
+            outputs = [self.apply_model_with_augmentations(pad_inputs(input_data, pad_width))
+                       for input_data, pad_width in zip(inputs, pad_widths)]
+        return [self.crop_output(out) for out in outputs]
+
 
 class InfernoPredicter(PytorchPredicter):
     def __init__(self, model_path, halo, gpu=0, use_best=True, prep_model=None,
-                 mixed_precision=False, **augmentation_kwargs):
+                 mixed_precision=False, gpu_preprocess=False, preprocess_kwargs=None,
+                 compile_model=False, **augmentation_kwargs):
         # load the model and prep it if specified
         assert os.path.exists(model_path), model_path
 
@@ -143,7 +339,7 @@ class InfernoPredicter(PytorchPredicter):
 
         self.model = Trainer().load(from_directory=model_path, best=use_best).model
         self.set_up(halo, gpu, use_best, prep_model, mixed_precision,
-                    **augmentation_kwargs)
+                    gpu_preprocess, preprocess_kwargs, compile_model, **augmentation_kwargs)
 
 
 # TODO
@@ -170,14 +366,80 @@ def get_predictor(framework):
 # Pre-processing functions
 #
 
+# not parallel, because the pre-processing runs in the io threads; nogil, so that they don't block each other
+@jit(nogil=True, fastmath=True, cache=True)
+def _sum_and_sum_of_squares_numba(flat):
+    sum_, sum_sq = 0., 0.
+    for i in range(flat.size):
+        val = float(flat[i])
+        sum_ += val
+        sum_sq += val * val
+    return sum_, sum_sq
+
+
+def _sum_and_sum_of_squares_numpy(flat, chunk_size=2**20):
+    # accumulate in float64 over chunks to avoid full-size temporaries
+    sum_, sum_sq = 0., 0.
+    for start in range(0, flat.size, chunk_size):
+        chunk = flat[start:start + chunk_size].astype('float64')
+        sum_ += chunk.sum()
+        sum_sq += np.dot(chunk, chunk)
+    return sum_, sum_sq
+
+
+@jit(nogil=True, fastmath=True, cache=True)
+def _cast_normalize_numba(src, dst, mean, scale):
+    for i in range(src.size):
+        dst[i] = (src[i] - mean) * scale
+
+
+def _cast_normalize_numpy(src, dst, mean, scale):
+    np.subtract(src, mean, out=dst)
+    dst *= scale
+
+
+_sum_and_sum_of_squares = _sum_and_sum_of_squares_numpy if _sum_and_sum_of_squares_numba is None\
+    else _sum_and_sum_of_squares_numba
+_cast_normalize_impl = _cast_normalize_numpy if _cast_normalize_numba is None else _cast_normalize_numba
+
+
+def mean_and_std(data, filter_zeros=True):
+    # zeros don't contribute to the sums, so filtering them only changes the number of values
+    # and we can compute mean and std in a single pass without masking the data
+    n_values = np.count_nonzero(data) if filter_zeros else data.size
+    if n_values == 0:
+        return 0., 0.
+    sum_, sum_sq = _sum_and_sum_of_squares(data.ravel())
+    mean = sum_ / n_values
+    var = max(sum_sq / n_values - mean * mean, 0.)
+    return float(mean), float(np.sqrt(var))
+
+
+# cast and normalize in a single pass, without an intermediate copy for the cast
+def cast_normalize(data, eps=1e-4, mean=None, std=None, filter_zeros=True, dtype='float32'):
+    if mean is None or std is None:
+        data_mean, data_std = mean_and_std(data, filter_zeros)
+        mean = data_mean if mean is None else mean
+        std = data_std if std is None else std
+    out = np.empty(data.shape, dtype=dtype)
+    _cast_normalize_impl(data.ravel(), out.ravel(), float(mean), 1. / (std + eps))
+    return out
+
+
 def normalize(data, eps=1e-4, mean=None, std=None, filter_zeros=True):
-    if filter_zeros:
-        data_pre = data[data != 0]
-    else:
-        data_pre = data
-    mean = data_pre.mean() if mean is None else mean
-    std = data_pre.std() if std is None else std
-    return (data - mean) / (std + eps)
+    dtype = np.result_type(data.dtype, 'float32')
+    return cast_normalize(data, eps=eps, mean=mean, std=std,
+                          filter_zeros=filter_zeros, dtype=dtype)
+
+
+# pad an array or a list of arrays (with one pad width per array) on the host
+def pad_inputs(input_data, pad_width, mode='reflect'):
+    if pad_width is None:
+        return input_data
+    if isinstance(input_data, np.ndarray):
+        return np.pad(input_data, pad_width, mode=mode)
+    return [data if this_pad_width is None else np.pad(data, this_pad_width, mode=mode)
+            for data, this_pad_width in zip(input_data, pad_width)]
 
 
 def normalize01(data, eps=1e-4):
@@ -192,12 +454,32 @@ def cast(data, dtype='float32'):
 
 def preprocess_torch(data, mean=None, std=None,
                      use_zero_mean_unit_variance=True):
-    normalizer = partial(normalize, mean=mean, std=std)\
-        if use_zero_mean_unit_variance else normalize01
+    # zero-mean unit-variance normalization is fused with the cast to float32
+    if use_zero_mean_unit_variance:
+        normalizer = partial(cast_normalize, mean=mean, std=std)
+    else:
+        def normalizer(d):
+            return normalize01(cast(d))
+    if isinstance(data, np.ndarray):
+        data = normalizer(data)
+    elif isinstance(data, (list, tuple)):
+        data = [normalizer(d) for d in data]
+    else:
+        raise ValueError("Invalid type %s" % type(data))
+    return data
+
+
+# if the normalization is done on the gpu by the predictor, we only need to make
+# sure that the data can be converted to torch, which only supports uint8 as unsigned type
+def preprocess_torch_gpu(data):
+    def _to_torch_dtype(d):
+        if d.dtype.kind == 'u' and d.dtype != np.dtype('uint8'):
+            return d.astype('float32')
+        return d
     if isinstance(data, np.ndarray):
-        data = normalizer(cast(data))
+        data = _to_torch_dtype(data)
     elif isinstance(data, (list, tuple)):
-        data = [normalizer(cast(d)) for d in data]
+        data = [_to_torch_dtype(d) for d in data]
     else:
         raise ValueError("Invalid type %s" % type(data))
     return data
@@ -208,8 +490,10 @@ def preprocess_tf():
     pass
 
 
-def get_preprocessor(framework, **kwargs):
+def get_preprocessor(framework, gpu_preprocess=False, **kwargs):
     if framework in ('inferno', 'pytorch'):
+        if gpu_preprocess:
+            return preprocess_torch_gpu
         return partial(preprocess_torch, **kwargs)
     elif framework == 'tensorflow':
         return partial(preprocess_tf, **kwargs)
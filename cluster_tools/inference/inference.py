@@ -3,11 +3,11 @@
 import os
 import sys
 import json
+from collections import deque
+from concurrent import futures
 
 import luigi
-import dask
 import numpy as np
-import toolz as tz
 import nifty.tools as nt
 
 import cluster_tools.utils.volume_utils as vu
@@ -16,6 +16,7 @@ from cluster_tools.utils.task_utils import DummyTask
 from cluster_tools.cluster_tasks import SlurmTask, LocalTask, LSFTask
 from cluster_tools.inference.frameworks import get_predictor, get_preprocessor
 from cluster_tools.inference.prep_model import get_prep_model
+from cluster_tools.utils.numba_utils import jit
 
 
 #
@@ -50,11 +51,13 @@ class InferenceBase(luigi.Task):
     def default_task_config():
         # we use this to get also get the common default config
         config = LocalTask.default_task_config()
-        config.update({'dtype': 'uint8', 'compression': 'gzip', 'chunks': None,
+        # lz4 compresses much faster than gzip; hdf5 outputs fall back to gzip
+        config.update({'dtype': 'uint8', 'compression': 'lz4', 'chunks': None,
                        'device_mapping': None, 'use_best': True, 'tda_config': {},
                        'prep_model': None, "gpu_type": "2080Ti",
                        'channel_accumulation': None, 'mixed_precision': False,
-                       'preprocess_kwargs': {}})
+                       'preprocess_kwargs': {}, 'gpu_preprocess': False, 'batch_size': 1,
+                       'compile_model': False, 'min_foreground_fraction': None})
         return config
 
     def clean_up_for_retry(self, block_list):
@@ -75,7 +78,7 @@ class InferenceBase(luigi.Task):
         # load the task config
         config = self.get_task_config()
         dtype = config.pop('dtype', 'uint8')
-        compression = config.pop('compression', 'gzip')
+        compression = vu.get_compression(self.output_path, config.pop('compression', 'lz4'))
         chunks = config.pop('chunks', None)
         assert dtype in ('uint8', 'float32')
 
@@ -172,7 +175,7 @@ class InferenceLSF(InferenceBase, LSFTask):
 #
 
 
-def _load_input(ds, offset, block_shape, halo, padding_mode='reflect'):
+def _load_input(ds, offset, block_shape, halo, padding_mode='reflect', return_pad_width=False):
 
     shape = ds.shape
     starts = [off - ha for off, ha in zip(offset, halo)]
@@ -200,9 +203,38 @@ def _load_input(ds, offset, block_shape, halo, padding_mode='reflect'):
         pad_left = (0, 0, 0) if pad_left is None else pad_left
         pad_right = (0, 0, 0) if pad_right is None else pad_right
         pad_width = tuple((pl, pr) for pl, pr in zip(pad_left, pad_right))
+        # we can leave reflect padding to the predictor, which pads on the gpu,
+        # if the padding is smaller than the data along all axes
+        if return_pad_width and padding_mode == 'reflect' and\
+                all(pl < sh and pr < sh for (pl, pr), sh in zip(pad_width, data.shape)):
+            return data, pad_width
         data = np.pad(data, pad_width, mode=padding_mode)
 
-    return data
+    return (data, None) if return_pad_width else data
+
+
+# not parallel, because this runs in the writer threads; nogil, so that they don't block each other
+@jit(nogil=True, cache=True)
+def _to_uint8_numba(src, dst, mult, add):
+    for i in range(src.size):
+        val = np.rint(src[i] * mult + add)
+        if val < 0:
+            val = 0.
+        elif val > 255:
+            val = 255.
+        dst[i] = np.uint8(val)
+
+
+def _to_uint8_numpy(src, dst, mult, add):
+    # scale, round and clip in-place in a single temporary
+    scaled = src * mult
+    scaled += add
+    np.rint(scaled, out=scaled)
+    np.clip(scaled, 0, 255, out=scaled)
+    dst[:] = scaled
+
+
+_to_uint8_impl = _to_uint8_numpy if _to_uint8_numba is None else _to_uint8_numba
 
 
 def _to_uint8(data, float_range=(0., 1.), safe_scale=True):
@@ -211,25 +243,182 @@ def _to_uint8(data, float_range=(0., 1.), safe_scale=True):
     else:
         mult = np.ceil(255./(float_range[1]-float_range[0]))
     add = 255 - mult*float_range[1]
-    return np.clip((data*mult+add).round(), 0, 255).astype('uint8')
+    out = np.empty(data.shape, dtype='uint8')
+    _to_uint8_impl(data.ravel(), out.ravel(), float(mult), float(add))
+    return out
+
+
+def _is_empty(inputs, min_foreground_fraction=0.):
+    """ Check if the input(s) of a block have less than min_foreground_fraction non-zero values.
+
+    For min_foreground_fraction = 0 only blocks without any non-zero value are empty.
+    """
+    inputs = [inputs] if isinstance(inputs, np.ndarray) else inputs
+    if min_foreground_fraction == 0:
+        return not any(inp.any() for inp in inputs)
+    n_foreground = sum(np.count_nonzero(inp) for inp in inputs)
+    return n_foreground < min_foreground_fraction * sum(inp.size for inp in inputs)
+
+
+def _make_writers(ds_out, channel_mapping, channel_accumulation, dtype, align_bb=None):
+    """ Build the functions that write the (cropped) output of a block to the output datasets.
+
+    The channel selection, channel accumulation and cast to uint8 only depend on the job config,
+    so we decide on them once here instead of for every block.
+    Returns one function per output dataset with the signature 'write(output, bb)'.
+    """
+    cast = _to_uint8 if dtype == 'uint8' else None
+
+    def _make_convert(dso, chan_start, chan_stop):
+        n_channels = chan_stop - chan_start
+        if dso.ndim == 3:
+            if channel_accumulation is None:
+                assert n_channels == 1
+        else:
+            assert n_channels == dso.shape[0]
+
+        # single channels are selected with an integer index to drop the channel axis
+        channel = chan_start if n_channels == 1 else slice(chan_start, chan_stop)
+        accumulate = None if n_channels == 1 else channel_accumulation
+        if accumulate is None:
+            def select(output):
+                return output[channel] if output.ndim == 4 else output
+        else:
+            def select(output):
+                return accumulate(output[channel], axis=0) if output.ndim == 4 else output
+
+        if cast is None:
+            return select
+
+        def convert(output):
+            return cast(select(output))
+        return convert
+
+    def _make_writer(dso, chann_mapping):
+        convert = _make_convert(dso, *chann_mapping)
+        prefix = tuple() if dso.ndim == 3 else (slice(None),)
+        if align_bb is None:
+            def write(output, bb):
+                dso[prefix + bb] = convert(output)
+        else:
+            def write(output, bb):
+                channel_output = convert(output)
+                dso[align_bb(prefix + bb, channel_output.shape)] = channel_output
+        return write
+
+    return [_make_writer(dso, chann_mapping) for dso, chann_mapping in zip(ds_out, channel_mapping)]
+
+
+class _SerialExecutor(futures.Executor):
+    """ Executor that runs the submitted functions right away in the calling thread.
+    """
+    def submit(self, fn, *args, **kwargs):
+        future = futures.Future()
+        try:
+            future.set_result(fn(*args, **kwargs))
+        except BaseException as e:
+            future.set_exception(e)
+        return future
+
+
+def _make_pools(n_threads):
+    """ Make the io and writer pools for '_run_pipeline', such that they use at most
+    n_threads threads together with the calling thread, which runs the prediction.
+
+    Returns the io pool, the writer pool and the number of threads of each pool.
+    """
+    n_workers = n_threads - 1
+    # with a single thread, everything runs in the calling thread
+    if n_workers < 1:
+        pool = _SerialExecutor()
+        return pool, pool, 1, 1
+    # with two threads, loading and writing share one thread
+    if n_workers == 1:
+        pool = futures.ThreadPoolExecutor(1)
+        return pool, pool, 1, 1
+    # writing includes the compression, so we reserve half of the threads for it
+    n_write_threads = (n_workers + 1) // 2
+    n_io_threads = n_workers - n_write_threads
+    return (futures.ThreadPoolExecutor(n_io_threads), futures.ThreadPoolExecutor(n_write_threads),
+            n_io_threads, n_write_threads)
+
+
+def _run_pipeline(block_list, load_input, predict, write_output,
+                  n_threads, batch_size=1):
+    """ Run inference for the blocks in block_list as producer / consumer pipeline:
+    the inputs are loaded (and pre-processed) by a pool of io threads, the prediction
+    runs only in the calling thread, so the gpu is never used concurrently,
+    and the outputs are written by a pool of writer threads.
+
+    load_input(block_id) returns the input data or None if the block should be skipped,
+    predict(inputs) predicts a batch of inputs and write_output(block_id, output) writes
+    the prediction for a block.
+    """
+    io_pool, write_pool, n_io_threads, n_write_threads = _make_pools(n_threads)
+    # bound the number of blocks that are loaded ahead of the prediction
+    # and the number of outputs that are waiting to be written
+    max_prefetch = 2 * batch_size + n_io_threads
+    max_pending_writes = 2 * n_write_threads + batch_size
+
+    def _write(block_id, output):
+        if output is not None:
+            write_output(block_id, output)
+        fu.log_block_success(block_id)
+        return 1
+
+    n_success = 0
+    with io_pool, write_pool:
+
+        blocks = iter(block_list)
+        loading, writing = deque(), deque()
+
+        def _prefetch():
+            for block_id in blocks:
+                loading.append((block_id, io_pool.submit(load_input, block_id)))
+                if len(loading) >= max_prefetch:
+                    break
+
+        # submit the write and return right away, unless too many writes are pending
+        def _submit_write(block_id, output):
+            nonlocal n_success
+            writing.append(write_pool.submit(_write, block_id, output))
+            while len(writing) > max_pending_writes:
+                n_success += writing.popleft().result()
+
+        _prefetch()
+        batch = []
+        while loading:
+            block_id, inputs = loading.popleft()
+            inputs = inputs.result()
+            _prefetch()
+
+            if inputs is None:
+                _submit_write(block_id, None)
+            else:
+                batch.append((block_id, inputs))
+
+            if batch and (len(batch) == batch_size or not loading):
+                block_ids, inputs = zip(*batch)
+                outputs = predict(list(inputs))
+                for block_id, output in zip(block_ids, outputs):
+                    _submit_write(block_id, output)
+                batch = []
+
+        n_success += sum(t.result() for t in writing)
+    return n_success
 
 
 def _run_inference(blocking, block_list, halo, ds_in, ds_out, mask,
                    preprocess, predict, channel_mapping, channel_accumulation,
-                   n_threads):
+                   n_threads, batch_size=1, min_foreground_fraction=None):
 
     block_shape = blocking.blockShape
     dtypes = [dso.dtype for dso in ds_out]
     dtype = dtypes[0]
     assert all(dtp == dtype for dtp in dtypes)
 
-    @dask.delayed
-    def log1(block_id):
-        fu.log("start processing block %i" % block_id)
-        return block_id
-
-    @dask.delayed
     def load_input(block_id):
+        fu.log("start processing block %i" % block_id)
         block = blocking.getBlock(block_id)
 
         # if we have a mask, check if this block is in mask
@@ -237,34 +426,22 @@ def _run_inference(blocking, block_list, halo, ds_in, ds_out, mask,
             bb = vu.block_to_bb(block)
             bb_mask = mask[bb].astype('bool')
             if np.sum(bb_mask) == 0:
-                return block_id, None
-
-        return block_id, _load_input(ds_in, block.begin, block_shape, halo)
-
-    @dask.delayed
-    def preprocess_impl(inputs):
-        block_id, data = inputs
-        if data is None:
-            return block_id, None
-        data = preprocess(data)
-        return block_id, data
-
-    @dask.delayed
-    def predict_impl(inputs):
-        block_id, data = inputs
-        if data is None:
-            return block_id, None
-        data = predict(data)
-        return block_id, data
-
-    # TODO de-spagehttify
-    @dask.delayed
-    def write_output(inputs):
-        block_id, output = inputs
-
-        if output is None:
-            return block_id
+                return None
+
+        # the input is not padded yet, padding is done on the gpu by the predictor
+        data, pad_width = _load_input(ds_in, block.begin, block_shape, halo, return_pad_width=True)
+        # skip blocks without (enough) foreground before pre-processing and predicting them
+        if min_foreground_fraction is not None and _is_empty(data, min_foreground_fraction):
+            return None
+        return preprocess(data), pad_width
+
+    def predict_impl(batch):
+        inputs, pad_widths = map(list, zip(*batch))
+        return predict.predict_batch(inputs, pad_widths)
+
+    writers = _make_writers(ds_out, channel_mapping, channel_accumulation, dtype)
 
+    def write_output(block_id, output):
         out_shape = output.shape
         if len(out_shape) == 3:
             assert len(ds_out) == 1
@@ -281,50 +458,14 @@ def _run_inference(blocking, block_list, halo, ds_in, ds_out, mask,
             output = output[block_bb]
 
         # write the output to our output dataset(s)
-        for dso, chann_mapping in zip(ds_out, channel_mapping):
-            chan_start, chan_stop = chann_mapping
+        for write in writers:
+            write(output, bb)
 
-            if dso.ndim == 3:
-                if channel_accumulation is None:
-                    assert chan_stop - chan_start == 1
-                out_bb = bb
-            else:
-                assert output.ndim == 4
-                assert chan_stop - chan_start == dso.shape[0]
-                out_bb = (slice(None),) + bb
-
-            if output.ndim == 4:
-                channel_output = output[chan_start:chan_stop].squeeze()
-            else:
-                channel_output = output
-
-            # apply channel accumulation if specified
-            if channel_accumulation is not None and channel_output.ndim == 4:
-                channel_output = channel_accumulation(channel_output, axis=0)
-
-            # cast to uint8 if necessary
-            if dtype == 'uint8':
-                channel_output = _to_uint8(channel_output)
-
-            dso[out_bb] = channel_output
-
-        return block_id
-
-    @dask.delayed
-    def log2(block_id):
-        fu.log_block_success(block_id)
-        return 1
-
-    # iterate over the blocks in block list, get the input data and predict
-    results = []
-    for block_id in block_list:
-        res = tz.pipe(block_id, log1, load_input,
-                      preprocess_impl, predict_impl,
-                      write_output, log2)
-        results.append(res)
-
-    success = dask.compute(*results, scheduler='threads', num_workers=n_threads)
-    fu.log('Finished prediction for %i blocks' % sum(success))
+    # run loading, prediction and writing of the blocks as a pipeline,
+    # the prediction only runs in this thread
+    n_success = _run_pipeline(block_list, load_input, predict_impl, write_output,
+                              n_threads, batch_size)
+    fu.log('Finished prediction for %i blocks' % n_success)
 
 
 def inference(job_id, config_path):
@@ -344,6 +485,8 @@ def inference(job_id, config_path):
     halo = config['halo']
     framework = config['framework']
     n_threads = config['threads_per_job']
+    batch_size = config.get('batch_size', 1)
+    min_foreground_fraction = config.get('min_foreground_fraction', None)
     use_best = config.get('use_best', True)
     mixed_precision = config.get('mixed_precision', False)
     channel_accumulation = config.get('channel_accumulation', None)
@@ -351,7 +494,9 @@ def inference(job_id, config_path):
         fu.log("Accumulating channels with %s" % channel_accumulation)
         channel_accumulation = getattr(np, channel_accumulation)
 
-    fu.log("run inference with framework %s, with %i threads" % (framework, n_threads))
+    fu.log("run inference with framework %s, with %i threads and batch size %i" % (framework,
+                                                                                  n_threads,
+                                                                                  batch_size))
     fu.log("input block size is %s and halo is %s" % (str(block_shape), str(halo)))
 
     output_keys = config['output_keys']
@@ -375,12 +520,21 @@ def inference(job_id, config_path):
     if prep_model is not None:
         prep_model = get_prep_model(prep_model)
 
+    preprocess_kwargs = config.get('preprocess_kwargs', {})
+    gpu_preprocess = config.get('gpu_preprocess', False)
+    if gpu_preprocess:
+        fu.log("Pre-processing inputs on the gpu")
+    compile_model = config.get('compile_model', False)
+    if compile_model:
+        fu.log("Compiling the model")
+
     predict = get_predictor(framework)(checkpoint_path, halo, gpu=gpu, prep_model=prep_model,
                                        use_best=use_best, mixed_precision=mixed_precision,
-                                       **tda_config)
+                                       gpu_preprocess=gpu_preprocess,
+                                       preprocess_kwargs=preprocess_kwargs,
+                                       compile_model=compile_model, **tda_config)
     fu.log("Have model")
-    preprocess_kwargs = config.get('preprocess_kwargs', {})
-    preprocess = get_preprocessor(framework, **preprocess_kwargs)
+    preprocess = get_preprocessor(framework, gpu_preprocess=gpu_preprocess, **preprocess_kwargs)
 
     shape = vu.get_shape(input_path, input_key)
     blocking = nt.blocking(roiBegin=[0, 0, 0],
@@ -401,7 +555,8 @@ def inference(job_id, config_path):
             mask = None
         _run_inference(blocking, block_list, halo, ds_in, ds_out, mask,
                        preprocess, predict, channel_mapping,
-                       channel_accumulation, n_threads)
+                       channel_accumulation, n_threads, batch_size,
+                       min_foreground_fraction)
     fu.log_job_success(job_id)
 
 
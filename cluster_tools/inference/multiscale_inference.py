@@ -3,12 +3,11 @@
 import os
 import sys
 import json
+from concurrent import futures
 from warnings import warn
 
 import luigi
-import dask
 import numpy as np
-import toolz as tz
 import nifty.tools as nt
 
 import cluster_tools.utils.volume_utils as vu
@@ -16,7 +15,7 @@ import cluster_tools.utils.function_utils as fu
 from cluster_tools.utils.task_utils import DummyTask
 from cluster_tools.cluster_tasks import SlurmTask, LocalTask, LSFTask
 from cluster_tools.inference.frameworks import get_predictor, get_preprocessor
-from cluster_tools.inference.inference import get_prep_model, _to_uint8
+from cluster_tools.inference.inference import get_prep_model, _is_empty, _make_writers, _run_pipeline
 
 
 #
@@ -56,9 +55,12 @@ class MultiscaleInferenceBase(luigi.Task):
     def default_task_config():
         # we use this to get also get the common default config
         config = LocalTask.default_task_config()
-        config.update({'dtype': 'uint8', 'compression': 'gzip', 'chunks': None,
+        # lz4 compresses much faster than gzip; hdf5 outputs fall back to gzip
+        config.update({'dtype': 'uint8', 'compression': 'lz4', 'chunks': None,
                        'gpu_type': '2080Ti', 'device_mapping': None,
-                       'use_best': True, 'prep_model': None, 'channel_accumulation': None})
+                       'use_best': True, 'prep_model': None, 'channel_accumulation': None,
+                       'batch_size': 1, 'preprocess_kwargs': {}, 'gpu_preprocess': False,
+                       'compile_model': False, 'min_foreground_fraction': None})
         return config
 
     def run_impl(self):
@@ -70,7 +72,7 @@ class MultiscaleInferenceBase(luigi.Task):
         # load the task config
         config = self.get_task_config()
         dtype = config.pop('dtype', 'uint8')
-        compression = config.pop('compression', 'gzip')
+        compression = vu.get_compression(self.output_path, config.pop('compression', 'lz4'))
         chunks = config.pop('chunks', None)
         assert dtype in ('uint8', 'float32')
 
@@ -205,49 +207,59 @@ def _center_align_offset(offset, shape, reference_shape, scale_factor):
     return [sh // 2 - dist for sh, dist in zip(shape, center_distance)]
 
 
-def _load_input(ds, offset, block_shape, halo, scale_factor,
-                reference_shape, padding_mode='reflect'):
-    shape = ds.shape
-    this_offset = _center_align_offset(offset, shape, reference_shape, scale_factor)
+def _get_geometry(ds, block_shape, halo, scale_factor, reference_shape):
+    # the geometry of a scale is the same for all blocks, so it only needs to be computed once:
+    # the (center aligned) offset at this scale is 'center - (reference_center - offset) // scale_factor'
+    # (see '_center_align_offset'), the block shape and halo are given at this scale
+    shape = np.array(ds.shape)
+    scale_factor = np.array(scale_factor)
+    this_block_shape = np.array(block_shape) // scale_factor
+    return shape, shape // 2, np.array(reference_shape) // 2, scale_factor, this_block_shape, np.array(halo)
 
-    this_block_shape = [bs // sf for bs, sf in zip(block_shape, scale_factor)]
 
-    starts = [off - ha for off, ha in zip(this_offset, halo)]
-    stops = [off + bs + ha for off, bs, ha in zip(this_offset,
-                                                  this_block_shape,
-                                                  halo)]
+def _get_geometries(datasets, block_shape, halos, scale_factors):
+    ref_shape = datasets[0].shape
+    return [_get_geometry(ds, block_shape, halo, sf, ref_shape)
+            for ds, sf, halo in zip(datasets, scale_factors, halos)]
 
-    # we pad the input volume if necessary
-    pad_left = None
-    pad_right = None
 
-    # check for padding to the left
-    if any(start < 0 for start in starts):
-        pad_left = tuple(abs(start) if start < 0 else 0 for start in starts)
-        starts = [max(0, start) for start in starts]
+def _load_input(ds, offset, geometry, padding_mode='reflect', return_pad_width=False):
+    shape, center, ref_center, scale_factor, block_shape, halo = geometry
+    this_offset = center - (ref_center - np.array(offset)) // scale_factor
 
-    # check for padding to the right
-    if any(stop > shape[i] for i, stop in enumerate(stops)):
-        pad_right = tuple(stop - shape[i] if stop > shape[i] else 0 for i, stop in enumerate(stops))
-        stops = [min(shape[i], stop) for i, stop in enumerate(stops)]
+    starts = this_offset - halo
+    stops = this_offset + block_shape + halo
 
-    bb = tuple(slice(start, stop) for start, stop in zip(starts, stops))
+    # we pad the input volume if necessary
+    pad_left = np.maximum(-starts, 0)
+    pad_right = np.maximum(stops - shape, 0)
+    bb = tuple(slice(int(start), int(stop))
+               for start, stop in zip(np.maximum(starts, 0), np.minimum(stops, shape)))
     data = ds[bb]
 
     # pad if necessary
-    if pad_left is not None or pad_right is not None:
-        pad_left = (0, 0, 0) if pad_left is None else pad_left
-        pad_right = (0, 0, 0) if pad_right is None else pad_right
-        pad_width = tuple((pl, pr) for pl, pr in zip(pad_left, pad_right))
+    if pad_left.any() or pad_right.any():
+        pad_width = tuple((int(pl), int(pr)) for pl, pr in zip(pad_left, pad_right))
+        # we can leave reflect padding to the predictor, which pads on the gpu,
+        # if the padding is smaller than the data along all axes
+        if return_pad_width and padding_mode == 'reflect' and\
+                all(pl < sh and pr < sh for (pl, pr), sh in zip(pad_width, data.shape)):
+            return data, pad_width
         data = np.pad(data, pad_width, mode=padding_mode)
 
-    return data
+    return (data, None) if return_pad_width else data
 
 
-def _load_inputs(datasets, offset, block_shape, halos, scale_factors):
-    ref_shape = datasets[0].shape
-    data = [_load_input(ds, offset, block_shape, halo, sf, ref_shape)
-            for ds, sf, halo in zip(datasets, scale_factors, halos)]
+# the geometries can be precomputed with '_get_geometries' if inputs are loaded for many blocks
+def _load_inputs(datasets, offset, block_shape, halos, scale_factors,
+                 return_pad_width=False, geometries=None):
+    if geometries is None:
+        geometries = _get_geometries(datasets, block_shape, halos, scale_factors)
+    data = [_load_input(ds, offset, geometry, return_pad_width=return_pad_width)
+            for ds, geometry in zip(datasets, geometries)]
+    if return_pad_width:
+        data, pad_widths = map(list, zip(*data))
+        return data, pad_widths
     return data
 
 
@@ -295,7 +307,7 @@ def align_out_bb(out_bb, out_shape):
 def _run_inference(blocking, block_list, halos, ds_in, ds_out, mask,
                    scale_factors, preprocess, predict, channel_mapping,
                    channel_accumulation, n_threads,
-                   multiscale_output):
+                   multiscale_output, batch_size=1, min_foreground_fraction=None):
 
     block_shape = blocking.blockShape
     if multiscale_output:
@@ -305,51 +317,61 @@ def _run_inference(blocking, block_list, halos, ds_in, ds_out, mask,
     dtype = dtypes[0]
     assert all(dtp == dtype for dtp in dtypes)
 
-    @dask.delayed
+    # get the blocks and their bounding boxes once, so we don't need to recompute them in each stage
+    blocks = {block_id: blocking.getBlock(block_id) for block_id in block_list}
+    bbs = {block_id: vu.block_to_bb(block) for block_id, block in blocks.items()}
+    # the geometry of the input scales is also the same for all blocks
+    geometries = _get_geometries(ds_in, block_shape, halos, scale_factors)
+
     def load_input(block_id):
         fu.log("start processing block %i" % block_id)
-        block = blocking.getBlock(block_id)
+        block = blocks[block_id]
 
         # if we have a mask, check if this block is in mask
         if mask is not None:
-            bb = vu.block_to_bb(block)
+            bb = bbs[block_id]
             bb_mask = mask[bb]
             if np.sum(bb_mask) == 0:
-                return block_id, None
-
-        inputs = _load_inputs(ds_in, block.begin,
-                              block_shape, halos, scale_factors)
-        return block_id, inputs
-
-    @dask.delayed
-    def preprocess_impl(inputs):
-        block_id, data = inputs
-        if data is None:
-            return block_id, None
-        data = preprocess(data)
-        return block_id, data
-
-    @dask.delayed
-    def predict_impl(inputs):
-        block_id, data = inputs
-        if data is None:
-            return block_id, None
-        data = predict(data)
-        return block_id, data
-
-    @dask.delayed
-    def write_output(inputs):
-        block_id, output = inputs
-
-        if output is None:
-            return block_id
+                return None
+
+        # the inputs are not padded yet, padding is done on the gpu by the predictor
+        inputs, pad_widths = _load_inputs(ds_in, block.begin,
+                                          block_shape, halos, scale_factors,
+                                          return_pad_width=True, geometries=geometries)
+        # skip blocks without (enough) foreground before pre-processing and predicting them
+        if min_foreground_fraction is not None and _is_empty(inputs, min_foreground_fraction):
+            return None
+        return preprocess(inputs), pad_widths
+
+    def predict_impl(batch):
+        inputs, pad_widths = map(list, zip(*batch))
+        return predict.predict_batch(inputs, pad_widths)
+
+    # build the writers for the output dataset(s) once;
+    # misalignment can happen for higher scales, which is hot-fixed by aligning the bounding box
+    if multiscale_output:
+        # we also precompute the output shape (None if the scale is not downsampled) and block shape per scale
+        reference_shape = tuple(re - rb for rb, re in zip(blocking.roiBegin, blocking.roiEnd))
+        output_scales = []
+        for datasets, scale_factor in zip(ds_out, scale_factors):
+            writers = _make_writers(datasets, channel_mapping, channel_accumulation, dtype,
+                                    align_bb=align_out_bb)
+            if np.prod(scale_factor) > 1:
+                this_shape = datasets[0].shape[-3:]
+                this_block_shape = [bs // sf for bs, sf in zip(block_shape, scale_factor)]
+            else:
+                this_shape, this_block_shape = None, block_shape
+            output_scales.append((scale_factor, datasets, writers, this_shape, this_block_shape))
+    else:
+        writers = _make_writers(ds_out, channel_mapping, channel_accumulation, dtype)
 
+    def write_output(block_id, output):
         if isinstance(output, (list, tuple)):
             output = output[0]
         out_shape = output.shape
         if len(out_shape) == 3:
             assert len(ds_out) == 1
-        bb = vu.block_to_bb(blocking.getBlock(block_id))
+        bb = bbs[block_id]
 
         # check if we need to crop the output
         # NOTE this is not cropping the halo, which is done beforehand in the
@@ -362,71 +384,33 @@ def _run_inference(blocking, block_list, halos, ds_in, ds_out, mask,
             output = output[block_bb]
 
         # write the output to our output dataset(s)
-        for dso, chann_mapping in zip(ds_out, channel_mapping):
-            chan_start, chan_stop = chann_mapping
-
-            if dso.ndim == 3:
-                if channel_accumulation is None:
-                    assert chan_stop - chan_start == 1
-                out_bb = bb
-            else:
-                assert output.ndim == 4
-                assert chan_stop - chan_start == dso.shape[0]
-                out_bb = (slice(None),) + bb
-
-            if output.ndim == 4:
-                channel_output = output[chan_start:chan_stop]
-                if channel_output.shape[0] == 1:
-                    channel_output = channel_output[0]
-            else:
-                channel_output = output
-
-            # apply channel accumulation if specified
-            if channel_accumulation is not None and channel_output.ndim == 4:
-                channel_output = channel_accumulation(channel_output, axis=0)
+        for write in writers:
+            write(output, bb)
 
-            # cast to uint8 if necessary
-            if dtype == 'uint8':
-                channel_output = _to_uint8(channel_output)
-
-            dso[out_bb] = channel_output
-
-        return block_id
-
-    @dask.delayed
-    def write_multiscale_output(inputs):
-        block_id, outputs = inputs
-
-        if outputs is None:
-            return block_id
+    def write_multiscale_output(block_id, outputs):
         assert isinstance(outputs, list)
         assert len(outputs) == len(scale_factors)
 
         # this is the output bounding box at the full reference shape
-        bb = vu.block_to_bb(blocking.getBlock(block_id))
-        reference_shape = tuple(re - rb for rb, re in zip(blocking.roiBegin, blocking.roiEnd))
+        bb = bbs[block_id]
 
         # TODO support different channel mappings for different scales
         # write out all the scales
-        for output, scale_factor, datasets in zip(outputs, scale_factors, ds_out):
+        for output, output_scale in zip(outputs, output_scales):
+            scale_factor, datasets, writers, this_shape, this_block_shape = output_scale
 
             out_shape = output.shape
             if len(out_shape) == 3:
                 assert len(datasets) == 1
 
-            if np.prod(scale_factor) > 1:
-                this_shape = datasets[0].shape
-                if len(this_shape) == 4:
-                    this_shape = this_shape[1:]
+            if this_shape is not None:
                 this_start = _center_align_offset([b.start for b in bb], this_shape,
                                                   reference_shape, scale_factor)
                 this_stop = _center_align_offset([b.stop for b in bb], this_shape,
                                                  reference_shape, scale_factor)
                 this_bb = tuple(slice(sta, sto) for sta, sto in zip(this_start, this_stop))
-                this_block_shape = [bs // sf for bs, sf in zip(block_shape, scale_factor)]
             else:
                 this_bb = bb
-                this_block_shape = block_shape
 
             # check if we need to crop the output
             # NOTE this is not cropping the halo, which is done beforehand in the
@@ -440,70 +424,32 @@ def _run_inference(blocking, block_list, halos, ds_in, ds_out, mask,
 
             # TODO support different channel for different scales
             # write the output to our output dataset(s)
-            for dso, chann_mapping in zip(datasets, channel_mapping):
-                chan_start, chan_stop = chann_mapping
-
-                if dso.ndim == 3:
-                    if channel_accumulation is None:
-                        assert chan_stop - chan_start == 1
-                    out_bb = this_bb
-                else:
-                    assert output.ndim == 4
-                    assert chan_stop - chan_start == dso.shape[0]
-                    out_bb = (slice(None),) + this_bb
-
-                if output.ndim == 4:
-                    channel_output = output[chan_start:chan_stop]
-                    if channel_output.shape[0] == 1:
-                        channel_output = channel_output[0]
-                else:
-                    channel_output = output
-
-                # apply channel accumulation if specified
-                if channel_accumulation is not None and channel_output.ndim == 4:
-                    channel_output = channel_accumulation(channel_output, axis=0)
-
-                # cast to uint8 if necessary
-                if dtype == 'uint8':
-                    channel_output = _to_uint8(channel_output)
-
-                # misalignment can happen for higher scale;
-                # this is just a hot-fix
-                out_bb = align_out_bb(out_bb, channel_output.shape)
-                dso[out_bb] = channel_output
-
-        return block_id
-
-    @dask.delayed
-    def log2(block_id):
-        fu.log_block_success(block_id)
-        return 1
+            for write in writers:
+                write(output, this_bb)
 
     # for debugging purposes
     debug_inputs = False
     if debug_inputs:
         n_debug = 4
-        results = []
-        for block_id in block_list[:n_debug]:
-            res = tz.pipe(block_id, load_input)
-            results.append(res)
-        results = dask.compute(*results, scheduler='threads', num_workers=n_threads)
-        for block_id, inputs in results:
+
+        def load_debug_input(block_id):
+            block = blocks[block_id]
+            return _load_inputs(ds_in, block.begin, block_shape, halos, scale_factors,
+                                geometries=geometries)
+
+        with futures.ThreadPoolExecutor(n_threads) as tp:
+            results = list(tp.map(load_debug_input, block_list[:n_debug]))
+        for block_id, inputs in zip(block_list[:n_debug], results):
             print("Show inputs for block", block_id)
             _show_inputs(inputs, scale_factors)
 
     else:
         # normal code strand, no debugging
-        # iterate over the blocks in block list, get the input data and predict
+        # run loading, prediction and writing of the blocks as a pipeline
         writer = write_multiscale_output if multiscale_output else write_output
-        results = []
-        for block_id in block_list:
-            res = tz.pipe(block_id, load_input,
-                          preprocess_impl, predict_impl,
-                          writer, log2)
-            results.append(res)
-        success = dask.compute(*results, scheduler='threads', num_workers=n_threads)
-        fu.log('Finished prediction for %i blocks' % sum(success))
+        n_success = _run_pipeline(block_list, load_input, predict_impl, writer,
+                                  n_threads, batch_size)
+        fu.log('Finished prediction for %i blocks' % n_success)
 
 
 def multiscale_inference(job_id, config_path):
@@ -529,6 +475,8 @@ def multiscale_inference(job_id, config_path):
     halos = config['halos']
     framework = config['framework']
     n_threads = config['threads_per_job']
+    batch_size = config.get('batch_size', 1)
+    min_foreground_fraction = config.get('min_foreground_fraction', None)
     use_best = config.get('use_best', True)
     multiscale_output = config.get('multiscale_output', False)
     channel_accumulation = config.get('channel_accumulation', None)
@@ -536,7 +484,9 @@ def multiscale_inference(job_id, config_path):
         fu.log("Accumulating channels with %s" % channel_accumulation)
         channel_accumulation = getattr(np, channel_accumulation)
 
-    fu.log("run inference with framework %s, with %i threads" % (framework, n_threads))
+    fu.log("run inference with framework %s, with %i threads and batch size %i" % (framework,
+                                                                                  n_threads,
+                                                                                  batch_size))
 
     output_keys = config['output_keys']
     channel_mapping = config['channel_mapping']
@@ -553,10 +503,20 @@ def multiscale_inference(job_id, config_path):
     if prep_model is not None:
         prep_model = get_prep_model(prep_model)
 
+    preprocess_kwargs = config.get('preprocess_kwargs', {})
+    gpu_preprocess = config.get('gpu_preprocess', False)
+    if gpu_preprocess:
+        fu.log("Pre-processing inputs on the gpu")
+    compile_model = config.get('compile_model', False)
+    if compile_model:
+        fu.log("Compiling the model")
+
     predict = get_predictor(framework)(checkpoint_path, halos, gpu=gpu, prep_model=prep_model,
-                                       use_best=use_best)
+                                       use_best=use_best, gpu_preprocess=gpu_preprocess,
+                                       preprocess_kwargs=preprocess_kwargs,
+                                       compile_model=compile_model)
     fu.log("Have model")
-    preprocess = get_preprocessor(framework)
+    preprocess = get_preprocessor(framework, gpu_preprocess=gpu_preprocess, **preprocess_kwargs)
 
     with vu.file_reader(input_path, 'r') as f_in, vu.file_reader(output_path) as f_out:
 
@@ -581,7 +541,7 @@ def multiscale_inference(job_id, config_path):
                        scale_factors, preprocess,
                        predict, channel_mapping,
                        channel_accumulation, n_threads,
-                       multiscale_output)
+                       multiscale_output, batch_size, min_foreground_fraction)
     fu.log_job_success(job_id)
 
 
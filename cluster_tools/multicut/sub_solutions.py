@@ -3,6 +3,7 @@
 import os
 import sys
 import json
+import threading
 from concurrent import futures
 
 import numpy as np
@@ -14,6 +15,7 @@ import nifty.distributed as ndist
 import cluster_tools.utils.volume_utils as vu
 import cluster_tools.utils.function_utils as fu
 from cluster_tools.cluster_tasks import SlurmTask, LocalTask, LSFTask
+from cluster_tools.utils.numba_utils import jit
 
 
 #
@@ -82,7 +84,8 @@ class SubSolutionsBase(luigi.Task):
         # make output dataset
         with vu.file_reader(self.output_path) as f:
             f.require_dataset(self.output_key, shape=shape, dtype='uint64',
-                              chunks=(25, 256, 256), compression='gzip')
+                              chunks=(25, 256, 256),
+                              **vu.get_compression_kwargs(self.output_path, 'zstd'))
 
         factor = 2**self.scale
         block_shape = tuple(bs * factor for bs in block_shape)
@@ -143,6 +146,7 @@ class SubSolutionsLSF(SubSolutionsBase, LSFTask):
 
 def _read_subresults(ds_results, block_node_prefix, blocking,
                      block_list, n_threads, initial_node_labeling=None):
+    block_shape = blocking.blockShape
 
     def read_subres(block_id):
         block = blocking.getBlock(block_id)
@@ -150,7 +154,7 @@ def _read_subresults(ds_results, block_node_prefix, blocking,
         block_path = block_node_prefix + str(block_id)
         nodes = ndist.loadNodes(block_path)
         # load the sub result for this block
-        chunk = tuple(beg // bs for beg, bs in zip(block.begin, blocking.blockShape))
+        chunk = tuple(beg // bs for beg, bs in zip(block.begin, block_shape))
         subres = ds_results.read_chunk(chunk)
 
         # subres is None -> this block has ignore label
@@ -167,45 +171,171 @@ def _read_subresults(ds_results, block_node_prefix, blocking,
                                                                 len(subres))
         return nodes, subres, int(subres.max()) + 1
 
+    # we read the blocks in one batch per thread instead of submitting a task per block,
+    # which saves the scheduling overhead for many small blocks
+    def read_subres_batch(block_ids):
+        return [read_subres(block_id) for block_id in block_ids]
+
+    batches = [batch.tolist() for batch in np.array_split(np.array(block_list, dtype='uint64'),
+                                                          min(n_threads, max(len(block_list), 1)))]
     with futures.ThreadPoolExecutor(n_threads) as tp:
-        tasks = [tp.submit(read_subres, block_id) for block_id in block_list]
-        results = [t.result() for t in tasks]
+        tasks = [tp.submit(read_subres_batch, batch) for batch in batches]
+        results = [res for t in tasks for res in t.result()]
 
     # filter and get results
     block_list = [block_id for block_id, res
                   in zip(block_list, results) if res is not None]
     block_nodes = [res[0] for res in results if res is not None]
     block_res = [res[1] for res in results if res is not None]
-    block_offsets = np.array([res[2] for res
+    block_max_ids = np.array([res[2] for res
                               in results if res is not None], dtype='uint64')
 
-    # get the offsets and add them to the block results to make these unique
-    block_offsets = np.roll(block_offsets, 1)
-    block_offsets[0] = 0
-    block_offsets = np.cumsum(block_offsets)
-    block_res = [bres + boff for bres, boff in zip(block_res, block_offsets)]
-
-    # apply the node labeling
-    if initial_node_labeling is not None:
+    # get the offsets and add them to the block results (in-place) to make these unique
+    block_offsets = np.zeros(len(block_max_ids), dtype='uint64')
+    np.cumsum(block_max_ids[:-1], out=block_offsets[1:])
+    block_res = [bres.astype('uint64', copy=False) for bres in block_res]
+    for bres, boff in zip(block_res, block_offsets):
+        bres += boff
+
+    # apply the node labeling; we only read the part of the labeling (dataset)
+    # that is covered by the non-zero nodes of the blocks in this job, zero stays mapped to zero
+    nz_nodes = [] if initial_node_labeling is None else\
+        [nodes[nodes != 0] for nodes in block_nodes if (nodes != 0).any()]
+    if nz_nodes:
         fu.log("Apply initial node labeling to block nodes")
-        block_nodes = [initial_node_labeling[nodes] for nodes in block_nodes]
+        min_node = int(min(nodes.min() for nodes in nz_nodes))
+        max_node = int(max(nodes.max() for nodes in nz_nodes))
+        node_labeling = initial_node_labeling[min_node:max_node + 1]
+
+        def _label_nodes(nodes):
+            labeled_nodes = np.zeros_like(nodes)
+            nz_mask = nodes != 0
+            labeled_nodes[nz_mask] = node_labeling[nodes[nz_mask] - np.uint64(min_node)]
+            return labeled_nodes
+
+        block_nodes = [_label_nodes(nodes) for nodes in block_nodes]
 
-    # construct result dicts for each block
     # keep zero mapped to zero
-    block_results = [{node_id: res_id if node_id != 0 else 0
-                      for node_id, res_id in zip(bnodes, bres)}
-                     for bnodes, bres in zip(block_nodes, block_res)]
-    return block_list, block_results
+    for bnodes, bres in zip(block_nodes, block_res):
+        bres[bnodes == 0] = 0
+    block_results = list(zip(block_nodes, block_res))
+
+    # if the blocks don't share any (non-zero) nodes and the node ids are dense,
+    # we use a single lookup table for all blocks, otherwise each block is relabeled
+    # with its own lookup table in '_write_block_res'
+    lut = None
+    nz_nodes = [bnodes[bnodes != 0] for bnodes in block_nodes]
+    n_nodes = sum(len(nodes) for nodes in nz_nodes)
+    if n_nodes > 0:
+        all_nodes = np.concatenate(nz_nodes)
+        node_range = int(all_nodes.max()) - int(all_nodes.min()) + 1
+        if node_range <= 2 * n_nodes and len(np.unique(all_nodes)) == n_nodes:
+            fu.log("Use a single lookup table for all blocks")
+            lut = _make_lut(np.concatenate(block_nodes), np.concatenate(block_res))
+    return block_list, block_results, lut
+
+
+# value of the lookup table entries that don't belong to a node
+_NO_NODE = np.iinfo('uint64').max
+
+
+def _make_lut(nodes, values):
+    # lookup table that covers the range of the non-zero node ids,
+    # shifted such that the first entry is reserved for the zero label
+    nz_nodes = nodes[nodes != 0]
+    offset = int(nz_nodes.min()) - 1 if nz_nodes.size else 0
+    lut = np.full(int(nodes.max()) - offset + 1, _NO_NODE, dtype='uint64')
+    lut[0] = 0
+    lut[nz_nodes - offset] = values[nodes != 0]
+    return lut, offset
+
+
+# the output (and index) buffers are allocated once per thread and re-used for all its blocks
+_buffers = threading.local()
+
+
+def _get_buffer(name, shape, dtype='uint64'):
+    size = int(np.prod(shape))
+    buffer = getattr(_buffers, name, None)
+    if buffer is None or buffer.size < size or buffer.dtype != dtype:
+        buffer = np.empty(size, dtype=dtype)
+        setattr(_buffers, name, buffer)
+    return buffer[:size].reshape(shape)
+
+
+# NOTE the returned segmentation is a thread-local buffer that is overwritten by the next block
+def _apply_lut(ws, lut, offset):
+    seg = _get_buffer('seg', ws.shape)
+    if offset == 0:
+        index = ws
+    else:
+        # shift the ids to the range of the table, zero is mapped to the first entry
+        index = _get_buffer('index', ws.shape)
+        np.subtract(ws, np.uint64(offset), out=index, casting='unsafe')
+        index[ws == 0] = 0
+    # we check the range of the ids beforehand and use mode='clip',
+    # which (unlike mode='raise') does not buffer the output
+    if index.max() >= lut.size:
+        raise KeyError("Block contains ids that are not in its nodes")
+    np.take(lut, index, out=seg, mode='clip')
+    if seg.max() == _NO_NODE:
+        raise KeyError("Block contains ids that are not in its nodes")
+    return seg
+
+
+# nogil, so that the kernel does not block the other threads of the thread pool;
+# not parallel, because the thread pool already runs one block per thread
+@jit(nogil=True, cache=True)
+def _remap_sorted_numba(src, dst, keys, values):
+    for i in range(src.size):
+        idx = np.searchsorted(keys, src[i])
+        if idx == keys.size or keys[idx] != src[i]:
+            raise KeyError("Block contains ids that are not in its nodes")
+        dst[i] = values[idx]
+
+
+def _remap_sorted_numpy(src, dst, keys, values):
+    idx = np.searchsorted(keys, src)
+    np.minimum(idx, keys.size - 1, out=idx)
+    if not np.array_equal(keys[idx], src):
+        raise KeyError("Block contains ids that are not in its nodes")
+    dst[:] = values[idx]
+
+
+_remap_sorted_impl = _remap_sorted_numpy if _remap_sorted_numba is None else _remap_sorted_numba
+
+
+def _remap_sorted(ws, nodes, values):
+    # relabel via binary search in the sorted nodes, for node ids that are too sparse for a lookup table
+    sorting = np.argsort(nodes)
+    keys, values = nodes[sorting], values[sorting]
+    # make sure that zero is mapped to zero, even if it is not part of the nodes
+    if keys[0] != 0:
+        keys = np.concatenate([np.zeros(1, dtype=keys.dtype), keys])
+        values = np.concatenate([np.zeros(1, dtype=values.dtype), values])
+    seg = _get_buffer('seg', ws.shape)
+    _remap_sorted_impl(ws.ravel(), seg.ravel(), keys, values)
+    return seg
+
+
+def _relabel_block(ws, nodes, values):
+    # we use a lookup table if it is not larger than the block or twice the number of nodes
+    nz_nodes = nodes[nodes != 0]
+    node_range = int(nz_nodes.max()) - int(nz_nodes.min()) + 1 if nz_nodes.size else 1
+    if node_range <= max(2 * len(nodes), ws.size):
+        return _apply_lut(ws, *_make_lut(nodes, values))
+    return _remap_sorted(ws, nodes, values)
 
 
 def _write_block_res(ds_in, ds_out,
-                     block_id, blocking, block_res):
+                     block_id, bb, block_res, lut=None):
     fu.log("start processing block %i" % block_id)
-    block = blocking.getBlock(block_id)
-    bb = vu.block_to_bb(block)
     ws = ds_in[bb]
 
-    seg = nt.takeDict(block_res, ws)
+    if lut is None:
+        seg = _relabel_block(ws, *block_res)
+    else:
+        seg = _apply_lut(ws, *lut)
     ds_out[bb] = seg
     fu.log_block_success(block_id)
 
@@ -243,9 +373,8 @@ def sub_solutions(job_id, config_path):
     if scale > 1:
         node_label_key = 's%i/node_labeling' % scale
         fu.log("scale %i > 1; reading node labeling from %s" % (scale, node_label_key))
-        ds_node_labeling = problem[node_label_key]
-        ds_node_labeling.n_threads = n_threads
-        initial_node_labeling = ds_node_labeling[:]
+        initial_node_labeling = problem[node_label_key]
+        initial_node_labeling.n_threads = n_threads
     else:
         initial_node_labeling = None
 
@@ -254,18 +383,23 @@ def sub_solutions(job_id, config_path):
     # TODO should be varlen dataset
     fu.log("reading subresults")
     block_node_prefix = os.path.join(problem_path, 's%i' % scale, sub_graph_identifier, 'block_')
-    block_list, block_results = _read_subresults(ds_results, block_node_prefix, blocking,
-                                                 block_list, n_threads, initial_node_labeling)
+    block_list, block_results, lut = _read_subresults(ds_results, block_node_prefix, blocking,
+                                                      block_list, n_threads, initial_node_labeling)
 
     fu.log("writing subresults")
+    bbs = [vu.block_to_bb(blocking.getBlock(block_id)) for block_id in block_list]
     # write the resulting segmentation
     with vu.file_reader(output_path) as f_out, vu.file_reader(ws_path, 'r') as f_in:
         ds_in = f_in[ws_key]
         ds_out = f_out[output_key]
-        with futures.ThreadPoolExecutor(n_threads) as tp:
+        # the blocks span several chunks, so if there are fewer blocks than threads,
+        # the remaining threads are used to read and write the chunks of a block in parallel
+        n_workers = max(1, min(n_threads, len(block_list)))
+        ds_in.n_threads = ds_out.n_threads = max(1, n_threads // n_workers)
+        with futures.ThreadPoolExecutor(n_workers) as tp:
             tasks = [tp.submit(_write_block_res, ds_in, ds_out,
-                               block_id, blocking, block_res)
-                     for block_id, block_res in zip(block_list, block_results)]
+                               block_id, bb, block_res, lut)
+                     for block_id, bb, block_res in zip(block_list, bbs, block_results)]
             [t.result() for t in tasks]
     fu.log_job_success(job_id)
 
@@ -118,15 +118,19 @@ def two_pass_assignments(job_id, config_path):
     with vu.file_reader(assignments_path, 'r') as f:
         relabeling = f[relabel_key][:]
     # expected format of relabeling:
-    # array[n_labels, 2]
+    # array[max_id + 1] lookup table (old id -> new consecutive id), if the ids are dense
+    # or array[n_labels, 2] otherwise:
     # first column holds the new old ids
     # second column holds the corresponding new (consecutive!) ids
-    assert relabeling.ndim == 2
-    assert relabeling.shape[1] == 2
-
-    n_labels = len(relabeling)
-    old_to_new = dict(zip(relabeling[:, 0], relabeling[:, 1]))
-    assignments = nt.takeDict(old_to_new, assignments)
+    assert relabeling.ndim in (1, 2)
+    if relabeling.ndim == 1:
+        n_labels = int(relabeling.max()) + 1
+        assignments = nt.take(relabeling, assignments)
+    else:
+        assert relabeling.shape[1] == 2
+        n_labels = len(relabeling)
+        old_to_new = dict(zip(relabeling[:, 0], relabeling[:, 1]))
+        assignments = nt.takeDict(old_to_new, assignments)
     assert n_labels > assignments.max(), "%i, %i" % (n_labels, assignments.max())
 
     fu.log("merge %i labels with ufd" % n_labels)
@@ -3,6 +3,7 @@
 import os
 import sys
 import json
+from concurrent import futures
 
 import luigi
 import numpy as np
@@ -11,6 +12,7 @@ import nifty.tools as nt
 import cluster_tools.utils.volume_utils as vu
 import cluster_tools.utils.function_utils as fu
 from cluster_tools.cluster_tasks import SlurmTask, LocalTask, LSFTask
+from cluster_tools.utils.numba_utils import jit
 
 
 class BackgroundSizeFilterBase(luigi.Task):
@@ -63,13 +65,14 @@ class BackgroundSizeFilterBase(luigi.Task):
             if self.output_key in f:
                 chunks = f[self.output_key].chunks
             f.require_dataset(self.output_key, shape=shape, chunks=chunks,
-                              dtype='uint64', compression='gzip')
+                              dtype='uint64', **vu.get_compression_kwargs(self.output_path, 'zstd'))
 
-        # we don't need any additional config besides the paths
+        # load the task config and update it with the paths
         res_path = self._parse_log(self.input().path)
-        config = {"input_path": self.input_path, "input_key": self.input_key,
-                  "output_path": self.output_path, "output_key": self.output_key,
-                  "block_shape": block_shape, 'res_path': res_path}
+        config = self.get_task_config()
+        config.update({"input_path": self.input_path, "input_key": self.input_key,
+                       "output_path": self.output_path, "output_key": self.output_key,
+                       "block_shape": block_shape, 'res_path': res_path})
         self._write_log('scheduling %i blocks to be processed' % len(block_list))
 
         # prime and run the jobs
@@ -107,29 +110,108 @@ class BackgroundSizeFilterLSF(BackgroundSizeFilterBase, LSFTask):
 #
 
 
-def apply_block(block_id, blocking, ds_in, ds_out, discard_ids):
+# the lookup table is only used if it is at most this much larger than the number of
+# discard ids or fits into this size (in bytes); otherwise we use np.isin
+MAX_LUT_FACTOR = 4
+MAX_LUT_SIZE = 2**24
+
+
+def _make_discard_lut(discard_ids):
+    # boolean lookup table that is True for the ids to be discarded,
+    # None if the ids are too large and sparse for a table
+    lut_size = int(discard_ids.max()) + 1 if len(discard_ids) else 0
+    if lut_size > max(MAX_LUT_FACTOR * len(discard_ids), MAX_LUT_SIZE):
+        return None
+    discard_lut = np.zeros(lut_size, dtype='bool')
+    discard_lut[discard_ids] = True
+    return discard_lut
+
+
+def _get_discard_mask(labels, discard_lut):
+    # labels larger than the largest discard id are never discarded
+    in_range = labels < discard_lut.size
+    discard_mask = np.zeros(labels.shape, dtype='bool')
+    discard_mask[in_range] = discard_lut[labels[in_range]]
+    return discard_mask
+
+
+# release the gil, because apply_block runs in a thread pool,
+# which already runs one block per thread, so the kernel itself is not parallel
+@jit(nogil=True, cache=True)
+def _discard_numba(labels, discard_lut, lut_size):
+    n_discarded = 0
+    for i in range(labels.size):
+        label = labels[i]
+        if label < lut_size and discard_lut[label]:
+            labels[i] = 0
+            n_discarded += 1
+    return n_discarded
+
+
+def _discard_numpy(labels, discard_lut, lut_size):
+    discard_mask = _get_discard_mask(labels, discard_lut)
+    labels[discard_mask] = 0
+    return np.count_nonzero(discard_mask)
+
+
+_discard_impl = _discard_numpy if _discard_numba is None else _discard_numba
+
+
+# up to this many discard ids, comparing against each id is cheaper than the lookup table
+MAX_COMPARE_IDS = 8
+
+
+def _discard_small(labels, discard_ids):
+    discard_mask = labels == discard_ids[0]
+    for discard_id in discard_ids[1:]:
+        discard_mask |= labels == discard_id
+    labels[discard_mask] = 0
+    return np.count_nonzero(discard_mask)
+
+
+# set the labels to be discarded to zero in-place and return the number of discarded voxels;
+# with numba this is a single pass over the labels without an intermediate mask
+def _discard(labels, discard_lut, discard_ids):
+    if len(discard_ids) == 0:
+        return 0
+    flat_labels = labels.ravel()
+    if len(discard_ids) <= MAX_COMPARE_IDS:
+        return _discard_small(flat_labels, discard_ids)
+    if discard_lut is None:
+        discard_mask = np.isin(flat_labels, discard_ids)
+        flat_labels[discard_mask] = 0
+        return np.count_nonzero(discard_mask)
+    return _discard_impl(flat_labels, discard_lut, flat_labels.dtype.type(discard_lut.size))
+
+
+def apply_block(block_id, bb, ds_in, ds_out, discard_lut, discard_ids):
     fu.log("start processing block %i" % block_id)
-    block = blocking.getBlock(block_id)
-    bb = tuple(slice(b, e) for b, e in zip(block.begin, block.end))
     labels = ds_in[bb]
 
     # check if everything is ignore label
-    if np.sum(labels) == 0:
+    if not labels.any():
         fu.log_block_success(block_id)
         return
 
-    discard_mask = np.in1d(labels, discard_ids).reshape(labels.shape)
-    # check if the discard-mask is empty
-    if np.sum(discard_mask) == 0:
+    n_discarded = _discard(labels, discard_lut, discard_ids)
+    # if we filter in-place, the block only needs to be written if labels were discarded
+    if n_discarded > 0 or ds_out is not ds_in:
         ds_out[bb] = labels
-        fu.log_block_success(block_id)
-        return
-
-    labels[discard_mask] = 0
-    ds_out[bb] = labels
     fu.log_block_success(block_id)
 
 
+def _apply_blocks(block_list, blocking, ds_in, ds_out, discard_lut, discard_ids, n_threads):
+    # compute the bounding boxes of all blocks once before submitting them
+    bbs = [vu.block_to_bb(blocking.getBlock(block_id)) for block_id in block_list]
+    # use the threads that are not needed for the blocks to read and write their chunks in parallel
+    n_workers = max(1, min(n_threads, len(block_list)))
+    ds_in.n_threads = ds_out.n_threads = max(1, n_threads // n_workers)
+    with futures.ThreadPoolExecutor(n_workers) as tp:
+        tasks = [tp.submit(apply_block, block_id, bb, ds_in, ds_out, discard_lut, discard_ids)
+                 for block_id, bb in zip(block_list, bbs)]
+        [t.result() for t in tasks]
+
+
 def background_size_filter(job_id, config_path):
     fu.log("start processing job %i" % job_id)
     fu.log("reading config from %s" % config_path)
@@ -144,47 +226,46 @@ def background_size_filter(job_id, config_path):
     block_list = config['block_list']
     block_shape = config['block_shape']
     res_path = config['res_path']
-
-    # get the shape
-    with vu.file_reader(input_path, 'r') as f:
-        ds = f[input_key]
-        shape = f[input_key].shape
-    blocking = nt.blocking(roiBegin=[0, 0, 0],
-                           roiEnd=list(shape),
-                           blockShape=list(block_shape))
+    n_threads = config.get('threads_per_job', 1)
 
     discard_ids = np.load(res_path)
+    # zero is mapped to zero anyway, discarding it would only count the background voxels as changed
+    discard_ids = discard_ids[discard_ids != 0]
     fu.log("Discarding %i ids" % len(discard_ids))
+    # the lookup table is not needed if we compare against the discard ids directly
+    discard_lut = None if len(discard_ids) <= MAX_COMPARE_IDS else _make_discard_lut(discard_ids)
 
     same_file = input_path == output_path
     in_place = same_file and input_key == output_key
 
-    if in_place:
-        with vu.file_reader(input_path) as f:
-            ds = f[input_key]
-            [apply_block(block_id, blocking, ds, ds, discard_ids)
-             for block_id in block_list]
-    elif same_file:
-        with vu.file_reader(input_path) as f:
-            ds_in = f[input_key]
-            ds_out = f[output_key]
-            [apply_block(block_id, blocking, ds_in, ds_out, discard_ids)
-             for block_id in block_list]
-    else:
-        with vu.file_reader(input_path, 'r') as f_in, vu.file_reader(output_path) as f_out:
-            ds_in = f_in[input_key]
-            ds_out = f_out[output_key]
-            [apply_block(block_id, blocking, ds_in, ds_out, discard_ids)
-             for block_id in block_list]
-
-    # copy the 'maxId' attribute if present
-    if job_id == 0 and not in_place:
-        with vu.file_reader(input_path, 'r') as f:
-            attrs = f[input_key].attrs
-            max_id = attrs.get('maxId', None)
-        if max_id is not None:
-            with vu.file_reader(output_path) as f:
-                f[output_key].attrs['maxId'] = max_id
+    # nothing to do if we filter in-place and don't discard any ids
+    if in_place and len(discard_ids) == 0:
+        for block_id in block_list:
+            fu.log_block_success(block_id)
+        fu.log_job_success(job_id)
+        return
+
+    def _filter(f_in, f_out):
+        ds_in = f_in[input_key]
+        ds_out = ds_in if in_place else f_out[output_key]
+        blocking = nt.blocking(roiBegin=[0, 0, 0],
+                               roiEnd=list(ds_in.shape),
+                               blockShape=list(block_shape))
+        _apply_blocks(block_list, blocking, ds_in, ds_out, discard_lut, discard_ids, n_threads)
+
+        # copy the 'maxId' attribute if present
+        if job_id == 0 and not in_place:
+            max_id = ds_in.attrs.get('maxId', None)
+            if max_id is not None:
+                ds_out.attrs['maxId'] = max_id
+
+    # we only open each file once for the whole job
+    with vu.file_reader(input_path, 'a' if same_file else 'r') as f_in:
+        if same_file:
+            _filter(f_in, f_in)
+        else:
+            with vu.file_reader(output_path) as f_out:
+                _filter(f_in, f_out)
 
     fu.log_job_success(job_id)
 
@@ -81,6 +81,19 @@ class FindLabelingLSF(FindLabelingBase, LSFTask):
     pass
 
 
+def _merge_uniques(uniques):
+    # the uniques of each job are sorted already, so we can merge them instead of
+    # computing np.unique from scratch: the stable sort (timsort) merges the sorted runs
+    # of the concatenated uniques and we only need to remove the duplicates across jobs afterwards
+    uniques.sort(kind='stable')
+    if len(uniques) == 0:
+        return uniques
+    is_unique = np.empty(len(uniques), dtype='bool')
+    is_unique[0] = True
+    np.not_equal(uniques[1:], uniques[:-1], out=is_unique[1:])
+    return uniques[is_unique]
+
+
 def find_labeling(job_id, config_path):
 
     fu.log("start processing job %i" % job_id)
@@ -94,16 +107,23 @@ def find_labeling(job_id, config_path):
     assignment_path = config['assignment_path']
     assignment_key = config['assignment_key']
 
+    # we memory map the uniques of the individual jobs and copy them into
+    # one pre-allocated buffer, which avoids the temporary copies of np.concatenate
+    inputs = [np.load(os.path.join(tmp_folder, 'find_uniques_job_%i.npy' % job_id), mmap_mode='r')
+              for job_id in range(n_jobs)]
+    offsets = np.cumsum([0] + [len(inp) for inp in inputs])
+    uniques = np.empty(int(offsets[-1]), dtype=np.result_type(*[inp.dtype for inp in inputs]))
+
     def _read_input(job_id):
-        return np.load(os.path.join(tmp_folder, 'find_uniques_job_%i.npy' % job_id))
+        uniques[offsets[job_id]:offsets[job_id + 1]] = inputs[job_id]
 
     fu.log("read uniques")
     with futures.ThreadPoolExecutor(n_threads) as tp:
         tasks = [tp.submit(_read_input, job_id) for job_id in range(n_jobs)]
-        uniques = np.concatenate([t.result() for t in tasks])
+        [t.result() for t in tasks]
 
     fu.log("compute uniques")
-    uniques = np.unique(uniques)
+    uniques = _merge_uniques(uniques)
 
     if uniques[0] == 0:
         start_label = 0
@@ -113,12 +133,22 @@ def find_labeling(job_id, config_path):
         stop_label = len(uniques) + 1
     fu.log("relabel to new max-id %i" % stop_label)
     new_ids = np.arange(start_label, stop_label, dtype='uint64')
-    assignments = np.concatenate([uniques[:, None], new_ids[:, None]], axis=1)
+
+    # if the ids are dense enough, we save the assignments as lookup table (old id -> new id),
+    # which is not larger than the assignment table and can be applied directly (see write.py),
+    # otherwise we save the (n_ids, 2) assignment table
+    max_id = int(uniques[-1])
+    if max_id + 1 <= 2 * len(uniques):
+        fu.log("save assignments as lookup table")
+        assignments = np.zeros(max_id + 1, dtype='uint64')
+        assignments[uniques] = new_ids
+    else:
+        assignments = np.concatenate([uniques[:, None], new_ids[:, None]], axis=1)
 
     fu.log("saving results to %s/%s" % (assignment_path, assignment_key))
     with vu.file_reader(assignment_path) as f:
         chunk_size = min(int(1e6), len(assignments))
-        chunks = (chunk_size, 2)
+        chunks = (chunk_size,) if assignments.ndim == 1 else (chunk_size, 2)
         ds = vu.force_dataset(f, assignment_key, shape=assignments.shape, dtype='uint64',
                               compression='gzip', chunks=chunks)
         ds.n_threads = n_threads
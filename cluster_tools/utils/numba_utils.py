@@ -0,0 +1,17 @@
+# numba is optional: it is only used to compile some of the kernels of the block-wise
+# processing, which all have a numpy implementation that is used if numba is not available
+try:
+    from numba import njit
+except ImportError:
+    njit = None
+
+
+def jit(**jit_kwargs):
+    """ Decorator that compiles a kernel with 'numba.njit(**jit_kwargs)'.
+
+    The decorated kernel is None if numba is not available, so that
+    the caller can fall back to the numpy implementation of the kernel.
+    """
+    def decorator(func):
+        return None if njit is None else njit(**jit_kwargs)(func)
+    return decorator
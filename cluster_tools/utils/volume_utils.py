@@ -22,6 +22,30 @@ def file_reader(path, mode='a'):
     return elf.io.open_file(path, mode=mode)
 
 
+HDF5_EXTENSIONS = ('.h5', '.hdf', '.hdf5')
+
+
+# h5py only supports gzip, lzf and szip, so fall back to gzip
+# if another compression (e.g. lz4) is requested for a hdf5 file;
+# zarr gets lz4 through blosc (which uses lz4 by default)
+def get_compression(path, compression):
+    ext = os.path.splitext(path.rstrip('/'))[1].lower()
+    if ext in HDF5_EXTENSIONS and compression not in (None, 'gzip', 'lzf', 'szip'):
+        return 'gzip'
+    if ext == '.zarr' and compression == 'lz4':
+        return 'blosc'
+    return compression
+
+
+# keyword arguments to create a dataset with the given compression;
+# zstd is supported by n5 and zarr via blosc
+def get_compression_kwargs(path, compression, level=3):
+    compression = get_compression(path, compression)
+    if compression == 'zstd':
+        return {'compression': 'blosc', 'codec': 'zstd', 'level': level}
+    return {'compression': compression}
+
+
 def get_shape(path, key):
     with file_reader(path, 'r') as f:
         shape = f[key].shape
@@ -0,0 +1,99 @@
+import unittest
+from unittest import mock
+
+import numpy as np
+
+
+class TestInference(unittest.TestCase):
+    shape = (32, 64, 64)
+
+    def test_mean_and_std(self):
+        from cluster_tools.inference.frameworks import mean_and_std
+        data = np.random.randint(0, 255, size=self.shape).astype('uint8')
+        mean, std = mean_and_std(data, filter_zeros=False)
+        self.assertAlmostEqual(mean, data.mean(), places=4)
+        self.assertAlmostEqual(std, data.std(), places=4)
+
+        mean, std = mean_and_std(data, filter_zeros=True)
+        foreground = data[data != 0]
+        self.assertAlmostEqual(mean, foreground.mean(), places=4)
+        self.assertAlmostEqual(std, foreground.std(), places=4)
+
+        self.assertEqual(mean_and_std(np.zeros(self.shape, dtype='uint8')), (0., 0.))
+
+    def test_cast_normalize(self):
+        from cluster_tools.inference.frameworks import cast_normalize
+        data = np.random.randint(0, 255, size=self.shape).astype('uint8')
+        foreground = data[data != 0].astype('float64')
+        exp = (data - foreground.mean()) / (foreground.std() + 1e-4)
+        res = cast_normalize(data)
+        self.assertEqual(res.dtype, np.dtype('float32'))
+        self.assertTrue(np.allclose(res, exp, atol=1e-4))
+
+        res = cast_normalize(data, mean=100., std=10.)
+        self.assertTrue(np.allclose(res, (data - 100.) / (10. + 1e-4), atol=1e-4))
+
+    def test_to_uint8(self):
+        from cluster_tools.inference.inference import _to_uint8
+        data = (1.5 * np.random.rand(*self.shape) - .25).astype('float32')
+        exp = np.clip(np.rint(255 * data), 0, 255).astype('uint8')
+        res = _to_uint8(data)
+        self.assertEqual(res.dtype, np.dtype('uint8'))
+        # float rounding can differ by one for values at x.5
+        self.assertLessEqual(np.abs(res.astype('int') - exp.astype('int')).max(), 1)
+
+    def test_run_pipeline(self):
+        from cluster_tools.inference.inference import _run_pipeline
+        block_list = list(range(50))
+
+        # blocks for which load_input returns None are skipped
+        def load_input(block_id):
+            return None if block_id % 7 == 0 else np.full(4, block_id)
+
+        def predict(inputs):
+            return [2 * inp for inp in inputs]
+
+        for n_threads in (1, 2, 4):
+            for batch_size in (1, 3):
+                outputs = {}
+
+                def write_output(block_id, output):
+                    outputs[block_id] = output
+
+                n_success = _run_pipeline(block_list, load_input, predict, write_output,
+                                          n_threads, batch_size)
+                self.assertEqual(n_success, len(block_list))
+                self.assertEqual(sorted(outputs.keys()), [bid for bid in block_list if bid % 7 != 0])
+                for block_id, output in outputs.items():
+                    self.assertTrue(np.array_equal(output, np.full(4, 2 * block_id)))
+
+    def test_inputs_to_device(self):
+        from cluster_tools.inference import frameworks
+
+        # we only check which transfer path is taken, so upload and prepare are mocked and
+        # the predicter is created without set-up, which would need a model and a gpu
+        def _transfer_names(input_data, pad_widths):
+            predicter = object.__new__(frameworks.PytorchPredicter)
+            predicter.upload = mock.Mock(side_effect=lambda batches, names: list(batches))
+            predicter.prepare = mock.Mock(side_effect=lambda tensor, pad_width=None: tensor)
+            with mock.patch.object(frameworks, 'torch'):
+                predicter.inputs_to_device(input_data, pad_widths)
+            return predicter.upload.call_args[0][1]
+
+        single_scale = [np.zeros(self.shape, dtype='float32') for _ in range(3)]
+        multi_scale = [[np.zeros(self.shape, dtype='float32') for _ in range(2)] for _ in range(3)]
+        pad_width = [(1, 1), (0, 0), (0, 0)]
+
+        # unpadded inputs are transferred as one named batch per scale
+        self.assertEqual(_transfer_names(single_scale, None), ['input0'])
+        self.assertEqual(_transfer_names(single_scale, [None] * 3), ['input0'])
+        self.assertEqual(_transfer_names(multi_scale, [[None, None]] * 3), ['input0', 'input1'])
+
+        # padded inputs are transferred individually and without cached buffers
+        self.assertEqual(_transfer_names(single_scale, [None, pad_width, None]), [None] * 3)
+        self.assertEqual(_transfer_names(multi_scale, [[None, None], [None, pad_width], [None, None]]),
+                         [None] * 6)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,126 @@
+import unittest
+from unittest import mock
+
+import numpy as np
+
+
+class _Block:
+    def __init__(self, begin):
+        self.begin = begin
+
+
+class _Blocking:
+    """ Minimal blocking along the first axis.
+    """
+    def __init__(self, block_shape):
+        self.blockShape = block_shape
+
+    def getBlock(self, block_id):
+        return _Block([block_id * self.blockShape[0], 0, 0])
+
+
+class _SubResults:
+    """ Minimal dataset that returns the sub result for the chunk of a block.
+    """
+    def __init__(self, subresults):
+        self.subresults = subresults
+
+    def read_chunk(self, chunk):
+        return self.subresults[chunk[0]]
+
+
+class _NodeLabeling:
+    """ Minimal dataset that records which part of the node labeling is read.
+    """
+    def __init__(self, labeling):
+        self.labeling = labeling
+        self.keys = []
+
+    def __getitem__(self, key):
+        self.keys.append(key)
+        return self.labeling[key]
+
+
+class TestSubSolutions(unittest.TestCase):
+    shape = (32, 64, 64)
+
+    def _make_problem(self, nodes):
+        ws = np.random.choice(nodes, size=self.shape)
+        values = np.random.randint(0, 100, size=len(nodes)).astype('uint64')
+        values[nodes == 0] = 0
+        exp = values[np.searchsorted(nodes, ws)]
+        return ws, values, exp
+
+    def test_relabel_block(self):
+        from cluster_tools.multicut.sub_solutions import _relabel_block
+        # dense node ids (lookup table), node ids with offset and sparse node ids (sorted remap)
+        for nodes in (np.arange(0, 500, dtype='uint64'),
+                      np.concatenate([[0], np.arange(10000, 10500)]).astype('uint64'),
+                      np.unique(np.random.randint(1, 2**40, size=500)).astype('uint64')):
+            ws, values, exp = self._make_problem(nodes)
+            res = _relabel_block(ws, nodes, values)
+            self.assertTrue(np.array_equal(res, exp))
+
+    def test_apply_lut(self):
+        from cluster_tools.multicut.sub_solutions import _apply_lut, _make_lut
+        nodes = np.array([0, 10, 12, 15], dtype='uint64')
+        values = np.array([0, 1, 2, 3], dtype='uint64')
+        lut = _make_lut(nodes, values)
+        ws = np.array([[0, 10], [12, 15]], dtype='uint64')
+        self.assertTrue(np.array_equal(_apply_lut(ws, *lut), [[0, 1], [2, 3]]))
+
+        # ids that are not nodes, between and above the node ids, must raise
+        for invalid_id in (11, 20):
+            ws[0, 0] = invalid_id
+            with self.assertRaises(KeyError):
+                _apply_lut(ws, *lut)
+
+    def test_read_subresults(self):
+        import cluster_tools.multicut.sub_solutions as sub_solutions
+        block_nodes = [np.array([0, 1, 2, 3], dtype='uint64'),
+                       np.array([0], dtype='uint64'),
+                       np.array([3, 4, 5], dtype='uint64'),
+                       np.array([5, 6], dtype='uint64')]
+        subresults = [np.array([0, 0, 1, 2], dtype='uint64'),
+                      None,
+                      np.array([0, 1, 1], dtype='uint64'),
+                      np.array([0, 0], dtype='uint64')]
+
+        def load_nodes(path):
+            return block_nodes[int(path.split('_')[-1])]
+
+        # the offsets are added to the sub results in-place, so each call gets copies of them
+        def load_subresults():
+            return _SubResults([None if res is None else res.copy() for res in subresults])
+
+        with mock.patch.object(sub_solutions.ndist, 'loadNodes', side_effect=load_nodes):
+            block_list, block_results, lut = sub_solutions._read_subresults(load_subresults(),
+                                                                            'block_', _Blocking([10, 10, 10]),
+                                                                            list(range(4)), n_threads=2)
+        # block 1 has no sub result
+        self.assertEqual(block_list, [0, 2, 3])
+        # the results are offset by the max ids + 1 of the previous blocks, zero stays zero
+        exp_results = [[0, 0, 1, 2], [3, 4, 4], [5, 5]]
+        for (nodes, res), exp_nodes, exp_res in zip(block_results, [block_nodes[0], block_nodes[2],
+                                                                    block_nodes[3]], exp_results):
+            self.assertTrue(np.array_equal(nodes, exp_nodes))
+            self.assertTrue(np.array_equal(res, exp_res))
+        # the blocks share nodes, so we can't use a single lookup table
+        self.assertIsNone(lut)
+
+        # only the node labeling of the non-zero nodes is read, zero stays mapped to zero
+        node_labeling = _NodeLabeling(np.array([5, 1, 1, 2, 2, 3, 4], dtype='uint64'))
+        with mock.patch.object(sub_solutions.ndist, 'loadNodes', side_effect=load_nodes):
+            _, block_results, _ = sub_solutions._read_subresults(load_subresults(),
+                                                                 'block_', _Blocking([10, 10, 10]),
+                                                                 list(range(4)), n_threads=2,
+                                                                 initial_node_labeling=node_labeling)
+        self.assertEqual(node_labeling.keys, [slice(1, 7)])
+        exp_nodes = [[0, 1, 1, 2], [2, 2, 3], [3, 4]]
+        for (nodes, res), exp_node, exp_res in zip(block_results, exp_nodes, exp_results):
+            self.assertTrue(np.array_equal(nodes, exp_node))
+            self.assertTrue(np.array_equal(res, exp_res))
+
+
+if __name__ == '__main__':
+    unittest.main()
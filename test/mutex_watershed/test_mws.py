@@ -101,5 +101,52 @@ class TestMws(BaseTest):
         self._check_result(with_mask=True)
 
 
+class TestTwoPassAssignments(BaseTest):
+    block_shape = [32, 32, 32]
+    shape = (64, 64, 64)
+    seg_key = 'seg'
+    assignments_key = 'assignments/two_pass_mws'
+    relabel_key = 'assignments/two_pass_mws_relabel'
+
+    # dense ids, so that the relabeling is saved as lookup table
+    def test_two_pass_assignments_dense_ids(self):
+        from cluster_tools.relabel import RelabelWorkflow
+        from cluster_tools.mutex_watershed.two_pass_assignments import TwoPassAssignmentsLocal
+
+        seg = np.random.randint(1, 500, size=self.shape).astype('uint64')
+        with z5py.File(self.output_path) as f:
+            f.create_dataset(self.seg_key, data=seg, chunks=tuple(self.block_shape))
+
+        # merge pairs of neighboring ids, as in the second pass of the two-pass mws
+        ids = np.unique(seg)
+        pairs = ids[:2 * (len(ids) // 4)].reshape((-1, 2))
+        np.save(os.path.join(self.tmp_folder, 'mws_two_pass_assignments_block_0.npy'), pairs)
+
+        task = RelabelWorkflow(tmp_folder=self.tmp_folder, config_dir=self.config_folder,
+                               max_jobs=self.max_jobs, target=self.target,
+                               input_path=self.output_path, input_key=self.seg_key,
+                               assignment_path=self.output_path, assignment_key=self.relabel_key)
+        task = TwoPassAssignmentsLocal(tmp_folder=self.tmp_folder, config_dir=self.config_folder,
+                                       max_jobs=self.max_jobs, dependency=task,
+                                       path=self.output_path, key=self.seg_key,
+                                       assignments_path=self.output_path,
+                                       assignments_key=self.assignments_key,
+                                       relabel_key=self.relabel_key)
+        ret = luigi.build([task], local_scheduler=True)
+        self.assertTrue(ret)
+
+        with z5py.File(self.output_path) as f:
+            relabeling = f[self.relabel_key][:]
+            node_labels = f[self.assignments_key][:]
+        self.assertEqual(relabeling.ndim, 1)
+
+        # the labels are indexed by the relabeled ids
+        pair_labels = node_labels[relabeling[pairs]]
+        self.assertTrue(np.array_equal(pair_labels[:, 0], pair_labels[:, 1]))
+        labels = node_labels[relabeling[ids]]
+        self.assertEqual(len(np.unique(labels)), len(ids) - len(pairs))
+        self.assertEqual(node_labels[0], 0)
+
+
 if __name__ == '__main__':
     unittest.main()
@@ -140,5 +140,39 @@ class TestPostprocess(BaseTest):
         self.assertAlmostEqual(ri, 0.)
 
 
+class TestBackgroundSizeFilter(unittest.TestCase):
+    shape = (32, 64, 64)
+
+    def _check_discard(self, labels, discard_ids):
+        from cluster_tools.postprocess.background_size_filter import (_discard, _make_discard_lut,
+                                                                      MAX_COMPARE_IDS)
+        discard_lut = None if len(discard_ids) <= MAX_COMPARE_IDS else _make_discard_lut(discard_ids)
+        exp = labels.copy()
+        discard_mask = np.isin(exp, discard_ids)
+        exp[discard_mask] = 0
+
+        res = labels.copy()
+        n_discarded = _discard(res, discard_lut, discard_ids)
+        self.assertEqual(n_discarded, discard_mask.sum())
+        self.assertTrue(np.array_equal(res, exp))
+
+    def test_discard(self):
+        labels = np.random.randint(0, 1000, size=self.shape).astype('uint64')
+        # no ids, few ids (compared directly) and many ids (lookup table)
+        for n_ids in (0, 5, 100):
+            discard_ids = np.random.choice(np.arange(1, 1000, dtype='uint64'), size=n_ids, replace=False)
+            self._check_discard(labels, discard_ids)
+
+    def test_discard_large_ids(self):
+        from cluster_tools.postprocess.background_size_filter import _make_discard_lut
+        # the ids are too large and sparse for a lookup table
+        discard_ids = (2**40 + np.arange(0, 100 * 2**20, 2**20)).astype('uint64')
+        self.assertIsNone(_make_discard_lut(discard_ids))
+        labels = np.random.choice(np.concatenate([discard_ids, np.arange(1, 100, dtype='uint64')]),
+                                  size=self.shape)
+        self._check_discard(labels, discard_ids)
+        self._check_discard(labels, discard_ids[:3])
+
+
 if __name__ == '__main__':
     unittest.main()
@@ -44,5 +44,59 @@ class TestRelabel(BaseTest):
         self._check_result()
 
 
+class TestFindLabeling(BaseTest):
+    block_shape = [32, 32, 32]
+    shape = (64, 64, 64)
+    input_key = 'seg'
+    output_key = 'relabeled'
+    assignment_key = 'assignments'
+
+    def _run_relabel(self, seg):
+        from cluster_tools.relabel import RelabelWorkflow
+        with z5py.File(self.output_path) as f:
+            f.create_dataset(self.input_key, data=seg, chunks=tuple(self.block_shape))
+        task = RelabelWorkflow(tmp_folder=self.tmp_folder, config_dir=self.config_folder,
+                               max_jobs=self.max_jobs, target=self.target,
+                               input_path=self.output_path, input_key=self.input_key,
+                               assignment_path=self.output_path,
+                               assignment_key=self.assignment_key,
+                               output_path=self.output_path, output_key=self.output_key)
+        ret = luigi.build([task], local_scheduler=True)
+        self.assertTrue(ret)
+
+    def _check_result(self, seg, expected_assignment_ndim):
+        with z5py.File(self.output_path) as f:
+            res = f[self.output_key][:]
+            assignments = f[self.assignment_key][:]
+        self.assertEqual(assignments.ndim, expected_assignment_ndim)
+
+        uniques = np.unique(seg)
+        exp = np.searchsorted(uniques, seg) + (0 if uniques[0] == 0 else 1)
+        self.assertEqual(res.shape, exp.shape)
+        self.assertTrue(np.array_equal(res, exp))
+
+    # dense ids are saved as lookup table
+    def test_dense_ids(self):
+        seg = np.random.randint(0, 500, size=self.shape).astype('uint64')
+        self._run_relabel(seg)
+        self._check_result(seg, 1)
+
+    # sparse ids are saved as assignment table
+    def test_sparse_ids(self):
+        seg = 1000 * np.random.randint(1, 500, size=self.shape).astype('uint64')
+        self._run_relabel(seg)
+        self._check_result(seg, 2)
+
+    def test_merge_uniques(self):
+        from cluster_tools.relabel.find_labeling import _merge_uniques
+        job_uniques = [np.unique(np.random.randint(0, 1000, size=200)).astype('uint64')
+                       for _ in range(8)]
+        uniques = np.concatenate(job_uniques)
+        exp = np.unique(uniques)
+        res = _merge_uniques(uniques)
+        self.assertTrue(np.array_equal(res, exp))
+        self.assertEqual(len(_merge_uniques(np.zeros(0, dtype='uint64'))), 0)
+
+
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,85 @@
+import unittest
+
+import numpy as np
+
+try:
+    import numba
+except ImportError:
+    numba = None
+
+
+# compare the numba kernels with their numpy implementations
+@unittest.skipIf(numba is None, "Need numba")
+class TestNumbaKernels(unittest.TestCase):
+    shape = (32, 64, 64)
+
+    def test_sum_and_sum_of_squares(self):
+        from cluster_tools.inference.frameworks import (_sum_and_sum_of_squares_numba,
+                                                        _sum_and_sum_of_squares_numpy)
+        for dtype in ('uint8', 'uint16', 'float32'):
+            data = (255 * np.random.rand(*self.shape)).astype(dtype).ravel()
+            res = _sum_and_sum_of_squares_numba(data)
+            exp = _sum_and_sum_of_squares_numpy(data, chunk_size=1000)
+            self.assertTrue(np.allclose(res, exp))
+
+    def test_cast_normalize(self):
+        from cluster_tools.inference.frameworks import _cast_normalize_numba, _cast_normalize_numpy
+        for dtype in ('uint8', 'uint16', 'float32'):
+            data = (255 * np.random.rand(*self.shape)).astype(dtype).ravel()
+            res = np.empty(data.shape, dtype='float32')
+            exp = np.empty(data.shape, dtype='float32')
+            _cast_normalize_numba(data, res, 127., 0.1)
+            _cast_normalize_numpy(data, exp, 127., 0.1)
+            self.assertTrue(np.allclose(res, exp, atol=1e-5))
+
+    def test_to_uint8(self):
+        from cluster_tools.inference.inference import _to_uint8_numba, _to_uint8_numpy
+        # include values outside of the range to check the clipping
+        data = (1.5 * np.random.rand(*self.shape) - .25).astype('float32').ravel()
+        res = np.empty(data.shape, dtype='uint8')
+        exp = np.empty(data.shape, dtype='uint8')
+        _to_uint8_numba(data, res, 255., 0.)
+        _to_uint8_numpy(data, exp, 255., 0.)
+        # float rounding can differ by one for values at x.5
+        self.assertLessEqual(np.abs(res.astype('int') - exp.astype('int')).max(), 1)
+        self.assertEqual(res.min(), 0)
+        self.assertEqual(res.max(), 255)
+
+    def test_remap_sorted(self):
+        from cluster_tools.multicut.sub_solutions import _remap_sorted_numba, _remap_sorted_numpy
+        # only even keys, so that the odd ids are not in the keys
+        keys = 2 * np.unique(np.random.randint(1, 2**40, size=1000, dtype='uint64'))
+        values = np.random.randint(0, 1000, size=len(keys)).astype('uint64')
+        src = np.random.choice(keys, size=10000)
+        res = np.empty(src.shape, dtype='uint64')
+        exp = np.empty(src.shape, dtype='uint64')
+        _remap_sorted_numba(src, res, keys, values)
+        _remap_sorted_numpy(src, exp, keys, values)
+        self.assertTrue(np.array_equal(res, exp))
+
+        # ids that are not in the keys must raise, both between and above the keys
+        for invalid_id in (keys[0] + 1, keys[-1] + 1):
+            invalid = np.concatenate([src[:10], np.array([invalid_id], dtype='uint64')])
+            out = np.empty(invalid.shape, dtype='uint64')
+            for impl in (_remap_sorted_numba, _remap_sorted_numpy):
+                with self.assertRaises(KeyError):
+                    impl(invalid, out, keys, values)
+
+    def test_discard(self):
+        from cluster_tools.postprocess.background_size_filter import (_discard_numba, _discard_numpy,
+                                                                      _make_discard_lut)
+        labels = np.random.randint(0, 1000, size=self.shape).astype('uint64').ravel()
+        discard_ids = np.unique(np.random.randint(1, 800, size=100)).astype('uint64')
+        discard_lut = _make_discard_lut(discard_ids)
+        lut_size = np.uint64(discard_lut.size)
+
+        res, exp = labels.copy(), labels.copy()
+        n_res = _discard_numba(res, discard_lut, lut_size)
+        n_exp = _discard_numpy(exp, discard_lut, lut_size)
+        self.assertEqual(n_res, n_exp)
+        self.assertTrue(np.array_equal(res, exp))
+        self.assertEqual(n_exp, np.isin(labels, discard_ids).sum())
+
+
+if __name__ == '__main__':
+    unittest.main()